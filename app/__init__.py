@@ -1,345 +1,558 @@
 import os
+import asyncio
 import logging
 import json
 from datetime import datetime
 
-from opentelemetry import trace
-
 from flask import Flask, request
+from opentelemetry import trace
 
-
-from app.utils import create_keycloak_user, apply_k8s_config, delete_keycloak_user, delete_k8s_namespace, \
-    create_grafana_user, delete_grafana_user, make_username, make_usernames, get_provisioned_users, \
-    get_old_provisioned_users, delete_namespace_resources, generate_password, check_namespace_exists, get_grafana_user, get_keycloak_admin
+from app.utils import make_username, make_usernames, iter_provisioned_users, generate_password, \
+    check_namespace_exists, is_namespace_terminating
+from app.jobs import submit_job, get_job
+from app.tracing import user_span
+from app import aio, scheduler, inventory, metrics
 
 app = Flask(__name__)
+metrics.init_app(app)
 logger = logging.getLogger(__name__)
 # logging.basicConfig(level=logging.DEBUG)
-tracer = trace.get_tracer_provider().get_tracer(__name__)
-
-with tracer.start_as_current_span("provisioner-flask-endpoint"):
-    logger.info("Provisioning flask endpoint.")
-    @app.route('/')
-    def home():
-        return "Hello"
 
+# Maximum number of namespaces reset at the same time by POST /reset, on the asyncio engine
+RESET_CONCURRENCY = int(os.environ.get('RESET_CONCURRENCY', 64))
+# Maximum number of users torn down at the same time by POST /cleanup, on the asyncio engine
+CLEANUP_CONCURRENCY = int(os.environ.get('CLEANUP_CONCURRENCY', 32))
+# Maximum number of users fixed at the same time by POST /sync, on the asyncio engine
+SYNC_CONCURRENCY = int(os.environ.get('SYNC_CONCURRENCY', 16))
+# Maximum number of users provisioned at the same time by POST /provisioner/batch, on the asyncio engine
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 8))
+# Highest "concurrency" a caller may ask for in the body of POST /reset and POST /provisioner/batch
+MAX_RESET_CONCURRENCY = int(os.environ.get('MAX_RESET_CONCURRENCY', 256))
+MAX_BATCH_CONCURRENCY = int(os.environ.get('MAX_BATCH_CONCURRENCY', 32))
+
+
+def forget_user(username):
+    """Drop a deleted user from the expiry scheduler and the inventory"""
+    try:
+        scheduler.unschedule_user(username)
+        inventory.remove_user(username)
+    except Exception as e:
+        # The user is gone from every backend: report it, the next reconciliation drops it
+        logger.error(f"Failed to forget deleted user {username}: {e}", exc_info=True)
+
+
+def get_optional_json():
+    """Get the JSON body of the request, or an empty dict when there is none"""
+    if not request.content_length or not request.is_json:
+        return {}
+    return request.get_json()
+
+
+def get_concurrency(data, default, maximum):
+    """Get the "concurrency" of the request body clamped to maximum, default when absent, or None when invalid"""
+    value = data.get('concurrency')
+    if value is None:
+        return min(default, maximum)
+
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        return None
+
+    return min(value, maximum) if value > 0 else None
+
+
+def is_async_request(data):
+    """Whether the caller asked to run the operation as a background job"""
+    value = request.args.get('async', data.get('async', False))
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+async def provision_user(email, full_name):
+    """Create the Keycloak user, namespace and Grafana account of a user, rolling back on failure; run on the engine"""
+    if not email and not full_name:
+        return {'message': 'Email address and full name are missing'}, 400
+
+    username = make_username(email, full_name)
+    trace.get_current_span().set_attribute('provisioner.username', username)
+    logger.info(f"will attempt to create sandbox with username : {username}")
+
+    user_data = await aio.create_keycloak_user(username, email)
+
+    if user_data == "CREATED":
+        return {'message': "USER ALREADY EXIST"}, 500
+
+    user_id, password = user_data
+
+    # Both steps only need the Keycloak user id and password
+    k8s_error, grafana_error = [
+        outcome if isinstance(outcome, Exception) else None
+        for outcome in await asyncio.gather(aio.apply_k8s_config(username, user_id),
+                                            aio.create_grafana_user(username, email, password),
+                                            return_exceptions=True)]
+
+    if k8s_error or grafana_error:
+        # Undo Keycloak and whichever of the two steps succeeded, all at once
+        rollback = [aio.delete_keycloak_user(username)]
+        if not k8s_error:
+            rollback.append(aio.delete_k8s_namespace(username))
+        if not grafana_error:
+            rollback.append(aio.delete_grafana_user(username))
+
+        for outcome in await asyncio.gather(*rollback, return_exceptions=True):
+            if isinstance(outcome, Exception):
+                logger.error(f"Failed to roll back sandbox of {username}: {outcome}", exc_info=outcome)
+
+        if k8s_error:
+            logger.error(f"Failed to create k8s user {username}: {k8s_error}", exc_info=k8s_error)
+            return {'message': "Can't create k8s user"}, 500
+        logger.error(f"Failed to create grafana user {username}: {grafana_error}", exc_info=grafana_error)
+        return {'message': "Can't create grafana user"}, 500
+
+    try:
+        await asyncio.to_thread(scheduler.schedule_new_user, username)
+        await asyncio.to_thread(inventory.record_user, username, user_id, email)
+    except Exception as e:
+        # The sandbox exists in every backend: report it, the next reconciliation records it
+        logger.error(f"Failed to record provisioned user {username}: {e}", exc_info=True)
+
+    return {
+        'message': 'User has been successfully created',
+        'user_id': user_id,
+        'password': password,
+        'username': username
+    }, 200
+
+
+def provision_users(data, job=None):
+    """Provision every user of data['users'] concurrently and report a result per user"""
+    users = data['users']
+    concurrency = data.get('concurrency', BATCH_CONCURRENCY)
+    results = [None] * len(users)
+
+    def requested_user(index):
+        return users[index] if isinstance(users[index], dict) else {}
+
+    async def provision(index):
+        user = requested_user(index)
+        with user_span('provision-user', None):
+            return await provision_user(user.get('email'), user.get('full_name'))
+
+    if job:
+        job.start(len(users))
+
+    for index, outcome, error in aio.run_concurrently(provision, range(len(users)), concurrency):
+        if error is not None:
+            logger.error(f"Failed to provision user #{index}: {error}", exc_info=error)
+            outcome = {'message': f'Failed to provision user: {error}'}, 500
+
+        body, status_code = outcome
+        results[index] = dict(body, email=requested_user(index).get('email'), status=status_code)
+        if job:
+            job.advance(body.get('username'), failed=status_code >= 400)
+
+    provisioned = sum(1 for result in results if result['status'] < 400)
+    return {
+        'message': 'Batch provisioning completed',
+        'total': len(users),
+        'provisioned': provisioned,
+        'failed': len(users) - provisioned,
+        'results': results
+    }, 200
+
+
+def reset_provisioned_namespaces(data, job=None):
+    """Reset the namespaces of all provisioned users, or of data['username'] only"""
+    try:
+        target_username = data.get('username')
+        
+        # Read users from the local inventory when it is fresh, otherwise stream them from Keycloak,
+        # resetting namespaces while later pages load
+        if not target_username and inventory.is_fresh():
+            users = inventory.get_users()
+        else:
+            users = iter_provisioned_users(target_username)
+        reset_namespaces = []
+        failed_resets = []
+ 
+        # Filter users if a specific username is provided
+        if target_username:
+            users = [user for user in users if user.username == target_username]
+            if not users:
+                return {'message': f'No provisioned user found with username: {target_username}'}, 404
+            if job:
+                job.start(len(users))
+        
+        concurrency = data.get('concurrency', RESET_CONCURRENCY)
+        usernames = (user.username for user in users if user.username)
 
-    @app.route('/provisioner', methods=['POST'])
-    def provisioner():
-        token = request.headers.get('Authorization')
+        async def reset_user(username):
+            with user_span('reset-user', username):
+                return await aio.delete_namespace_resources(username)
 
-        expected_token = os.environ.get('VERIFICATION_TOKEN')
+        # Delete all resources in each namespace, a bounded number at a time
+        for username, _, error in aio.run_concurrently(reset_user, usernames, concurrency):
+            if error is None:
+                logger.info(f"Reset namespace for user: {username}")
+                try:
+                    inventory.mark_reset(username)
+                except Exception as e:
+                    logger.error(f"Failed to record reset of user {username}: {e}", exc_info=True)
+                reset_namespaces.append(username)
+            else:
+                logger.error(f"Failed to reset namespace for user {username}: {error}", exc_info=error)
+                failed_resets.append(username)
+            if job:
+                job.advance(username, failed=error is not None)
 
-        if token != expected_token:
-            return {'message': 'Please submit a valid token'}, 401
+        message = 'All provisioned namespaces have been reset successfully' if not target_username else f'Namespace for user {target_username} has been reset successfully'
+        return {
+            'message': message,
+            'users_processed': len(reset_namespaces) + len(failed_resets),
+            'namespaces_reset': len(reset_namespaces),
+            'failed_resets': failed_resets
+        }, 200
+
+    except Exception as e:
+        logger.error(f"Failed to reset namespaces: {e}", exc_info=True)
+        return {'message': 'Failed to reset namespaces'}, 500
+
+
+def cleanup_expired_users(job=None):
+    """Delete every provisioned user older than the retention period, with its resources"""
+    try:
+        # Get the users whose retention period has ended from the created_at index of the inventory
+        old_users = inventory.get_expired_users()
+        
+        deleted_users = []
+        failed_deletions = []
+        
+        usernames = [user.username for user in old_users if user.username]
+        if job:
+            job.start(len(usernames))
+
+        async def cleanup_user(username):
+            with user_span('cleanup-user', username):
+                return await aio.teardown_user(username)
+
+        # Delete all resources for each old user, a bounded number of users at a time
+        for username, user_id, error in aio.run_concurrently(cleanup_user, usernames, CLEANUP_CONCURRENCY):
+            if error is None:
+                forget_user(username)
+                deleted_users.append({
+                    'username': username,
+                    'user_id': user_id
+                })
+            else:
+                logger.error(f"Failed to delete Keycloak user {username}: {error}", exc_info=error)
+                failed_deletions.append(username)
+            if job:
+                job.advance(username, failed=error is not None)
 
-        data = request.get_json()
-        email = data.get('email')
-        full_name = data.get('full_name')
+        return {
+            'message': 'Cleanup completed',
+            'deleted_users': deleted_users,
+            'failed_deletions': failed_deletions,
+            'total_processed': len(old_users),
+            'successfully_deleted': len(deleted_users),
+            'failed': len(failed_deletions)
+        }, 200
+
+    except Exception as e:
+        logger.error(f"Failed to perform cleanup: {e}", exc_info=True)
+        return {'message': 'Failed to perform cleanup'}, 500
+
+
+async def _sync_user(user, existing_namespaces, grafana_logins, check_unlabelled, sync_results):
+    """Recreate what a single provisioned user is missing, recording the outcome in sync_results.
+
+    Returns False when a fix failed.
+    """
+    username = user.username
+    email = user.email
+
+    try:
+        needs_grafana = username not in grafana_logins
+        needs_namespace = username not in existing_namespaces
+
+        # Namespaces created before the managed-by label existed are missing from the inventory
+        if needs_namespace and check_unlabelled:
+            needs_namespace = not await asyncio.to_thread(check_namespace_exists, username, unlabelled=True)
+            if not needs_namespace and not is_namespace_terminating(username):
+                await asyncio.to_thread(inventory.mark_present, username, namespace=True)
+
+        # A namespace being deleted is recreated once it is gone
+        if not needs_namespace and is_namespace_terminating(username):
+            needs_namespace = True
+
+        if needs_grafana or needs_namespace:
+            user_id = user.id
+            
+            if needs_grafana:
+                try:
+                    # Get user creation year from Keycloak
+                    creation_year = datetime.fromtimestamp(user.created_at).year
+                    
+                    # Create Grafana user with password based on creation year
+                    password = generate_password(username, creation_year)
+                    await aio.create_grafana_user(username, email, password)
+                    await asyncio.to_thread(inventory.mark_present, username, grafana=True)
+                    logger.info(f"Created missing Grafana user: {username}")
+                except Exception as e:
+                    logger.error(f"Failed to create Grafana user {username}: {e}", exc_info=True)
+                    sync_results['failed_fixes'].append({
+                        'username': username,
+                        'error': f"Failed to create Grafana user: {str(e)}"
+                    })
+                    return False
 
-        username = None
+            if needs_namespace:
+                try:
+                    # Create Kubernetes namespace
+                    await aio.apply_k8s_config(username, user_id)
+                    await asyncio.to_thread(inventory.mark_present, username, namespace=True)
+                    logger.info(f"Created missing namespace for user: {username}")
+                except Exception as e:
+                    logger.error(f"Failed to create namespace for user {username}: {e}", exc_info=True)
+                    sync_results['failed_fixes'].append({
+                        'username': username,
+                        'error': f"Failed to create namespace: {str(e)}"
+                    })
+                    return False
 
-        if not email and not full_name:
-            return {'message': 'Email address and full name are missing'}, 400
+            sync_results['fixed_users'].append({
+                'username': username,
+                'fixed_grafana': needs_grafana,
+                'fixed_namespace': needs_namespace
+            })
 
-        username = make_username(email, full_name)
-        logger.info(f"will attempt to create sandbox with username : {username}")
+    except Exception as e:
+        logger.error(f"Failed to sync user {username}: {e}", exc_info=True)
+        sync_results['failed_fixes'].append({
+            'username': username,
+            'error': str(e)
+        })
+        return False
 
-        user_data = create_keycloak_user(username, email)
+    return True
 
-        if user_data == "CREATED":
-            return {'message': "USER ALREADY EXIST"}, 500
 
-        user_id, password = user_data
+def sync_provisioned_users(data, job=None):
+    """Recreate missing Grafana accounts and namespaces of provisioned users, or of data['username'] only"""
+    try:
+        target_username = data.get('username')
+        
+        if target_username:
+            # Look the user up in Keycloak and probe its namespace and Grafana account directly
+            users = list(iter_provisioned_users(target_username))
+            if not users:
+                return {'message': f'No provisioned user found with username: {target_username}'}, 404
+            total_users = len(users)
+            existing_namespaces = ({target_username} if check_namespace_exists(target_username, unlabelled=True)
+                                   else set())
+            grafana_logins = {target_username} if aio.run(aio.get_grafana_user(target_username)) else set()
+        else:
+            # Reconcile the local inventory with the bulk Keycloak, Kubernetes and Grafana listings, so
+            # namespaces and Grafana accounts deleted since the last reconciliation are found, then read
+            # the users missing either of them
+            inventory.reconcile(refresh=True)
+            total_users = inventory.count_users()
+            candidates = inventory.get_incomplete_users()
+            users = [user for user, _, _ in candidates]
+            existing_namespaces = {user.username for user, namespace_present, _ in candidates if namespace_present}
+            grafana_logins = {user.username for user, _, grafana_present in candidates if grafana_present}
+
+        if job:
+            job.start(len(users))
+
+        sync_results = {
+            'total_users': total_users,
+            'fixed_users': [],
+            'failed_fixes': []
+        }
 
-        try:
-            apply_k8s_config(username, user_id)
-        except:
-            delete_keycloak_user(username)
-            return {'message': "Can't create k8s user"}, 500
+        async def sync_user(user):
+            with user_span('sync-user', user.username):
+                return await _sync_user(user, existing_namespaces, grafana_logins, not target_username, sync_results)
 
-        try:
-            create_grafana_user(username, email, password)
-        except:
-            delete_keycloak_user(username)
-            delete_k8s_namespace(username)
-            return {'message': "Can't create grafana user"}, 500
+        named_users = [user for user in users if user.username]
+        for user, synced, error in aio.run_concurrently(sync_user, named_users, SYNC_CONCURRENCY):
+            if error is not None:
+                logger.error(f"Failed to sync user {user.username}: {error}", exc_info=error)
+            if job:
+                job.advance(user.username, failed=not synced)
 
+        message = 'Sync completed for all users' if not target_username else f'Sync completed for user {target_username}'
         return {
-            'message': 'User has been successfully created',
-            'user_id': user_id,
-            'password': password,
-            'username': username
-        }
+            'message': message,
+            'results': sync_results
+        }, 200
+
+    except Exception as e:
+        logger.error(f"Failed to perform sync: {e}", exc_info=True)
+        return {'message': 'Failed to perform sync'}, 500
+
+
+@app.route('/')
+def home():
+    return "Hello"
 
 
-    @app.route('/provisioner', methods=['DELETE'])
-    def provisioner_clean():
-        token = request.headers.get('Authorization')
+@app.route('/provisioner', methods=['POST'])
+def provisioner():
+    token = request.headers.get('Authorization')
 
-        expected_token = os.environ.get('VERIFICATION_TOKEN')
+    expected_token = os.environ.get('VERIFICATION_TOKEN')
 
-        if token != expected_token:
-            return {'message': 'Please submit a valid token'}, 401
+    if token != expected_token:
+        return {'message': 'Please submit a valid token'}, 401
 
-        data = request.get_json()
-        email = data.get("email")
-        full_name = data.get('full_name')
+    data = request.get_json()
+    email = data.get('email')
+    full_name = data.get('full_name')
 
-        if not email and not full_name:
-            return {'message': 'Email address and full name are missing'}, 400
+    return aio.run(provision_user(email, full_name))
 
-        usernames = make_usernames(email, full_name)
 
-        for username in usernames:
-            try:
-                logger.info(f"Attempting to delete sandbox with username : {username}")
-                delete_k8s_namespace(username)
-                user_id = delete_keycloak_user(username)
-                delete_grafana_user(username)
-                return {
-                    'message': 'User has been deleted successfully',
-                    'user_id': user_id,
-                    'username': username
-                }
-            except Exception as e:
-                logger.error(f"Failed to delete with this username : {username} : {e}", exc_info=True)
+@app.route('/provisioner/batch', methods=['POST'])
+def provisioner_batch():
+    token = request.headers.get('Authorization')
 
-        return {"Failed to delete user and related resources, it may not exist."}, 500
+    expected_token = os.environ.get('VERIFICATION_TOKEN')
 
-    @app.route('/reset', methods=['POST'])
-    def reset_namespaces():
-        token = request.headers.get('Authorization')
+    if token != expected_token:
+        return {'message': 'Please submit a valid token'}, 401
 
-        expected_token = os.environ.get('VERIFICATION_TOKEN')
+    data = get_optional_json()
+    users = data.get('users')
 
-        if token != expected_token:
-            return {'message': 'Please submit a valid token'}, 401
+    if not isinstance(users, list) or not users:
+        return {'message': 'A non-empty list of users is required'}, 400
 
+    concurrency = get_concurrency(data, BATCH_CONCURRENCY, MAX_BATCH_CONCURRENCY)
+    if concurrency is None:
+        return {'message': 'concurrency must be a positive integer'}, 400
+    data = dict(data, concurrency=concurrency)
+
+    if is_async_request(data):
+        job = submit_job('provision', lambda job: provision_users(data, job))
+        return {'message': 'Batch provisioning has been scheduled', 'job_id': job.id}, 202
+
+    return provision_users(data)
+
+
+@app.route('/provisioner', methods=['DELETE'])
+def provisioner_clean():
+    token = request.headers.get('Authorization')
+
+    expected_token = os.environ.get('VERIFICATION_TOKEN')
+
+    if token != expected_token:
+        return {'message': 'Please submit a valid token'}, 401
+
+    data = request.get_json()
+    email = data.get("email")
+    full_name = data.get('full_name')
+
+    if not email and not full_name:
+        return {'message': 'Email address and full name are missing'}, 400
+
+    usernames = make_usernames(email, full_name)
+
+    for username in usernames:
         try:
-            # Check if request has a body
-            if not request.content_length or not request.is_json:
-                data = {}
-            else:
-                data = request.get_json()
-            
-            target_username = data.get('username')
-            
-            # Get all provisioned users from Keycloak
-            users = get_provisioned_users()
-            reset_namespaces = []
-            failed_resets = []
-     
-            # Filter users if a specific username is provided
-            if target_username:
-                users = [user for user in users if user.get('username') == target_username]
-                if not users:
-                    return {'message': f'No provisioned user found with username: {target_username}'}, 404
-            
-            # Delete all resources in each namespace
-            for user in users:
-                username = user.get('username')
-                if username:
-                    try:
-                        delete_namespace_resources(username)
-                        logger.info(f"Reset namespace for user: {username}")
-                        reset_namespaces.append(username)
-                    except Exception as e:
-                        print(e)
-                        logger.error(f"Failed to reset namespace for user {username}: {e}", exc_info=True)
-                        failed_resets.append(username)
-
-            message = 'All provisioned namespaces have been reset successfully' if not target_username else f'Namespace for user {target_username} has been reset successfully'
+            logger.info(f"Attempting to delete sandbox with username : {username}")
+            aio.run(aio.delete_k8s_namespace(username))
+            user_id = aio.run(aio.delete_keycloak_user(username))
+            aio.run(aio.delete_grafana_user(username))
+            forget_user(username)
             return {
-                'message': message,
-                'users_processed': len(users),
-                'namespaces_reset': len(reset_namespaces),
-                'failed_resets': failed_resets
+                'message': 'User has been deleted successfully',
+                'user_id': user_id,
+                'username': username
             }
-
         except Exception as e:
-            logger.error(f"Failed to reset namespaces: {e}", exc_info=True)
-            return {'message': 'Failed to reset namespaces'}, 500
+            logger.error(f"Failed to delete with this username : {username} : {e}", exc_info=True)
 
-    @app.route('/cleanup', methods=['POST'])
-    def cleanup_old_users():
-        token = request.headers.get('Authorization')
+    return {"Failed to delete user and related resources, it may not exist."}, 500
 
-        expected_token = os.environ.get('VERIFICATION_TOKEN')
 
-        if token != expected_token:
-            return {'message': 'Please submit a valid token'}, 401
+@app.route('/reset', methods=['POST'])
+def reset_namespaces():
+    token = request.headers.get('Authorization')
 
-        try:
-            # Get all old provisioned users
-            old_users = get_old_provisioned_users()
-            
-            deleted_users = []
-            failed_deletions = []
-            
-            # Delete all resources for each old user
-            for user in old_users:
-                username = user.get('username')
-                if not username:
-                    continue
-                    
-                try:
-                    logger.info(f"Cleaning up resources for user: {username}")
-                    
-                    # Delete namespace
-                    try:
-                        delete_k8s_namespace(username)
-                        logger.info(f"Deleted namespace for user: {username}")
-                    except Exception as e:
-                        logger.error(f"Failed to delete namespace for user {username}: {e}", exc_info=True)
-                    
-                    # Delete Grafana user
-                    try:
-                        delete_grafana_user(username)
-                        logger.info(f"Deleted Grafana user: {username}")
-                    except Exception as e:
-                        logger.error(f"Failed to delete Grafana user {username}: {e}", exc_info=True)
-                    
-                    # Delete Keycloak user
-                    try:
-                        user_id = delete_keycloak_user(username)
-                        logger.info(f"Deleted Keycloak user: {username}")
-                        deleted_users.append({
-                            'username': username,
-                            'user_id': user_id
-                        })
-                    except Exception as e:
-                        logger.error(f"Failed to delete Keycloak user {username}: {e}", exc_info=True)
-                        failed_deletions.append(username)
-                        
-                except Exception as e:
-                    logger.error(f"Failed to clean up user {username}: {e}", exc_info=True)
-                    failed_deletions.append(username)
+    expected_token = os.environ.get('VERIFICATION_TOKEN')
 
-            return {
-                'message': 'Cleanup completed',
-                'deleted_users': deleted_users,
-                'failed_deletions': failed_deletions,
-                'total_processed': len(old_users),
-                'successfully_deleted': len(deleted_users),
-                'failed': len(failed_deletions)
-            }
+    if token != expected_token:
+        return {'message': 'Please submit a valid token'}, 401
 
-        except Exception as e:
-            logger.error(f"Failed to perform cleanup: {e}", exc_info=True)
-            return {'message': 'Failed to perform cleanup'}, 500
+    data = get_optional_json()
 
-    @app.route('/sync', methods=['POST'])
-    def sync_users():
-        token = request.headers.get('Authorization')
+    concurrency = get_concurrency(data, RESET_CONCURRENCY, MAX_RESET_CONCURRENCY)
+    if concurrency is None:
+        return {'message': 'concurrency must be a positive integer'}, 400
+    data = dict(data, concurrency=concurrency)
 
-        expected_token = os.environ.get('VERIFICATION_TOKEN')
+    if is_async_request(data):
+        job = submit_job('reset', lambda job: reset_provisioned_namespaces(data, job))
+        return {'message': 'Namespace reset has been scheduled', 'job_id': job.id}, 202
 
-        if token != expected_token:
-            return {'message': 'Please submit a valid token'}, 401
+    return reset_provisioned_namespaces(data)
 
-        try:
-            # Check if request has a body
-            if not request.content_length or not request.is_json:
-                data = {}
-            else:
-                data = request.get_json()
-            
-            target_username = data.get('username')
-            
-            # Get all provisioned users from Keycloak
-            users = get_provisioned_users()
-            
-            print(target_username)
-            
-            # Filter users if a specific username is provided
-            if target_username:
-                users = [user for user in users if user.get('username') == target_username]
-                if not users:
-                    return {'message': f'No provisioned user found with username: {target_username}'}, 404
-            
-            sync_results = {
-                'total_users': len(users),
-                'fixed_users': [],
-                'failed_fixes': []
-            }
 
-            for user in users:
-                username = user.get('username')
-                email = user.get('email')
-                if not username:
-                    continue
+@app.route('/cleanup', methods=['POST'])
+def cleanup_old_users():
+    token = request.headers.get('Authorization')
 
-                try:
-                    # Check Grafana user
-                    grafana_user = get_grafana_user(username)
-                    needs_grafana = not grafana_user
-                    print(needs_grafana)
-
-                    # Check Kubernetes namespace
-                    needs_namespace = not check_namespace_exists(username)
-                    print(needs_namespace)
-
-                    if needs_grafana or needs_namespace:
-                        # Get user's password from Keycloak
-                        keycloak_admin = get_keycloak_admin()
-                        user_id = keycloak_admin.get_user_id(username)
-                        
-                        if needs_grafana:
-                            try:
-                                # Get user creation year from Keycloak
-                                created_timestamp = user.get('createdTimestamp', 0) / 1000  # Convert to seconds
-                                created_date = datetime.fromtimestamp(created_timestamp)
-                                creation_year = created_date.year
-                                
-                                # Create Grafana user with password based on creation year
-                                password = generate_password(username, creation_year)
-                                create_grafana_user(username, email, password)
-                                logger.info(f"Created missing Grafana user: {username}")
-                            except Exception as e:
-                                logger.error(f"Failed to create Grafana user {username}: {e}", exc_info=True)
-                                sync_results['failed_fixes'].append({
-                                    'username': username,
-                                    'error': f"Failed to create Grafana user: {str(e)}"
-                                })
-                                continue
-
-                        if needs_namespace:
-                            try:
-                                # Create Kubernetes namespace
-                                apply_k8s_config(username, user_id)
-                                logger.info(f"Created missing namespace for user: {username}")
-                            except Exception as e:
-                                logger.error(f"Failed to create namespace for user {username}: {e}", exc_info=True)
-                                sync_results['failed_fixes'].append({
-                                    'username': username,
-                                    'error': f"Failed to create namespace: {str(e)}"
-                                })
-                                continue
-
-                        sync_results['fixed_users'].append({
-                            'username': username,
-                            'fixed_grafana': needs_grafana,
-                            'fixed_namespace': needs_namespace
-                        })
+    expected_token = os.environ.get('VERIFICATION_TOKEN')
 
-                except Exception as e:
-                    logger.error(f"Failed to sync user {username}: {e}", exc_info=True)
-                    sync_results['failed_fixes'].append({
-                        'username': username,
-                        'error': str(e)
-                    })
+    if token != expected_token:
+        return {'message': 'Please submit a valid token'}, 401
+
+    data = get_optional_json()
+
+    if is_async_request(data):
+        job = submit_job('cleanup', cleanup_expired_users)
+        return {'message': 'Cleanup has been scheduled', 'job_id': job.id}, 202
+
+    return cleanup_expired_users()
+
+
+@app.route('/sync', methods=['POST'])
+def sync_users():
+    token = request.headers.get('Authorization')
+
+    expected_token = os.environ.get('VERIFICATION_TOKEN')
+
+    if token != expected_token:
+        return {'message': 'Please submit a valid token'}, 401
+
+    data = get_optional_json()
+
+    if is_async_request(data):
+        job = submit_job('sync', lambda job: sync_provisioned_users(data, job))
+        return {'message': 'Sync has been scheduled', 'job_id': job.id}, 202
+
+    return sync_provisioned_users(data)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    token = request.headers.get('Authorization')
+
+    expected_token = os.environ.get('VERIFICATION_TOKEN')
+
+    if token != expected_token:
+        return {'message': 'Please submit a valid token'}, 401
+
+    job = get_job(job_id)
+    if not job:
+        return {'message': f'No job found with id: {job_id}'}, 404
+
+    return job
 
-            message = 'Sync completed for all users' if not target_username else f'Sync completed for user {target_username}'
-            return {
-                'message': message,
-                'results': sync_results
-            }
 
-        except Exception as e:
-            logger.error(f"Failed to perform sync: {e}", exc_info=True)
-            return {'message': 'Failed to perform sync'}, 500
-        
-        
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,453 @@
+import os
+import ssl
+import json
+import atexit
+import queue
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+import aiohttp
+from yarl import URL
+
+from app.metrics import track_backend
+from app.tracing import traced, backend_span, aiohttp_trace_config
+from app.utils import get_keycloak_admin, get_k8s_api_client, get_namespaced_resources, find_cached_grafana_user, \
+    cache_grafana_user, forget_grafana_user, generate_password, render_k8s_template, is_namespace_terminating, \
+    GRAFANA_URL, KEYCLOAK_TOKEN_REFRESH_MARGIN, K8S_NAMESPACE_TERMINATION_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of calls in flight against each backend from the asyncio engine of a server process
+AIO_CONCURRENCY = {
+    'keycloak': int(os.environ.get('AIO_KEYCLOAK_CONCURRENCY', 32)),
+    'k8s': int(os.environ.get('AIO_K8S_CONCURRENCY', 64)),
+    'grafana': int(os.environ.get('AIO_GRAFANA_CONCURRENCY', 16)),
+}
+# Seconds allowed to a single backend call of the asyncio engine
+AIO_TIMEOUT = int(os.environ.get('AIO_TIMEOUT', 60))
+
+# Event loop of the engine, run forever by a thread of this process, and the backends it calls
+_engine_lock = threading.Lock()
+_loop = None
+_backends = None
+
+
+class BackendError(Exception):
+    """Error answer of a backend, carrying its HTTP status like the errors of the blocking clients"""
+
+    def __init__(self, backend, status_code, body):
+        self.status_code = status_code
+        super().__init__(f"{backend} answered {status_code}: {body[:200].decode(errors='replace')}")
+
+
+class Backends:
+    """Async HTTP sessions of Keycloak, Grafana and Kubernetes, opened on first use and shared by every engine call.
+
+    Credentials come from the blocking clients of app.utils, so both share the Keycloak token and KUBE_CONFIG.
+    """
+
+    def __init__(self):
+        # backend -> (session, path prefix of its API)
+        self._sessions = {}
+        self._sessions_lock = asyncio.Lock()
+        self._semaphores = {backend: asyncio.Semaphore(limit) for backend, limit in AIO_CONCURRENCY.items()}
+        self._keycloak_token = None
+        self._keycloak_refresh_at = None
+
+    def _open(self, backend, url, ssl=None, **kwargs):
+        """Open a session on the origin of url, returning it with the path of url as the prefix of every call"""
+        url = URL(url)
+        session = aiohttp.ClientSession(
+            base_url=url.origin(),
+            connector=aiohttp.TCPConnector(limit=AIO_CONCURRENCY[backend], ssl=ssl),
+            timeout=aiohttp.ClientTimeout(total=AIO_TIMEOUT),
+            trace_configs=[aiohttp_trace_config()],
+            **kwargs)
+        return session, url.path.rstrip('/')
+
+    async def _open_keycloak(self):
+        connection = (await asyncio.to_thread(get_keycloak_admin)).connection
+        return self._open('keycloak', f"{connection.server_url.rstrip('/')}/admin/realms/{connection.realm_name}")
+
+    async def _open_grafana(self):
+        return self._open('grafana', f"{GRAFANA_URL}/api",
+                          auth=aiohttp.BasicAuth(os.environ.get('GRAFANA_USER'), os.environ.get('GRAFANA_PASSWORD')))
+
+    async def _open_k8s(self):
+        configuration = (await asyncio.to_thread(get_k8s_api_client)).configuration
+
+        context = False
+        if configuration.verify_ssl:
+            context = ssl.create_default_context(cafile=configuration.ssl_ca_cert)
+            if configuration.cert_file:
+                context.load_cert_chain(configuration.cert_file, configuration.key_file)
+
+        return self._open('k8s', configuration.host, ssl=context)
+
+    async def close(self):
+        for session, _ in self._sessions.values():
+            await session.close()
+
+    async def _session(self, backend):
+        async with self._sessions_lock:
+            if backend not in self._sessions:
+                self._sessions[backend] = await getattr(self, f'_open_{backend}')()
+            return self._sessions[backend]
+
+    async def _keycloak_authorization(self):
+        """Bearer token of the shared KeycloakAdmin client, read again shortly before it expires"""
+        if self._keycloak_token is None or datetime.now() >= self._keycloak_refresh_at:
+            connection = (await asyncio.to_thread(get_keycloak_admin)).connection
+            self._keycloak_token = connection.token['access_token']
+            self._keycloak_refresh_at = connection.expires_at - timedelta(seconds=KEYCLOAK_TOKEN_REFRESH_MARGIN)
+        return f"Bearer {self._keycloak_token}"
+
+    async def _k8s_authorization(self):
+        """Authorization header of the shared Kubernetes client, read per call like the blocking client does"""
+        # Already loaded when the session was opened, so this does not block the loop
+        configuration = get_k8s_api_client().configuration
+        if configuration.refresh_api_key_hook is None:
+            return configuration.get_api_key_with_prefix('authorization')
+        # The exec or OIDC hook of KUBE_CONFIG refreshes an expired token, possibly by running a command
+        return await asyncio.to_thread(configuration.get_api_key_with_prefix, 'authorization')
+
+    async def request(self, backend, method, path, headers=None, location=False, **kwargs):
+        """Call a backend, with at most AIO_CONCURRENCY[backend] calls in flight, and return the decoded JSON body.
+
+        With location, return the last segment of the Location header instead, the id of a created Keycloak object.
+        """
+        session, prefix = await self._session(backend)
+        headers = dict(headers or {})
+        if backend == 'keycloak':
+            headers['Authorization'] = await self._keycloak_authorization()
+        elif backend == 'k8s':
+            authorization = await self._k8s_authorization()
+            if authorization:
+                headers['Authorization'] = authorization
+
+        async with self._semaphores[backend]:
+            async with session.request(method, prefix + path, headers=headers, **kwargs) as response:
+                status_code = response.status
+                body = await response.read()
+                created = response.headers.get('Location', '').rstrip('/').rsplit('/', 1)[-1]
+
+        if status_code >= 400:
+            raise BackendError(backend, status_code, body)
+        if location:
+            return created
+        return json.loads(body) if body else None
+
+
+async def request(backend, method, path, **kwargs):
+    """Call a backend through the sessions of the engine; only awaited on the engine loop"""
+    global _backends
+
+    if _backends is None:
+        _backends = Backends()
+    return await _backends.request(backend, method, path, **kwargs)
+
+
+def _get_loop():
+    """Get the engine loop of this process, starting its thread on first use"""
+    global _loop
+
+    with _engine_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='aio-engine', daemon=True).start()
+        return _loop
+
+
+def reset_engine():
+    """Drop the engine loop and its sessions, e.g. in a forked process where the loop thread does not exist"""
+    global _loop, _backends
+
+    with _engine_lock:
+        _loop = None
+        _backends = None
+
+
+@atexit.register
+def close_engine():
+    """Close the sessions of the engine when the process exits, while its loop thread still runs"""
+    with _engine_lock:
+        loop, backends = _loop, _backends
+
+    if loop is not None and backends is not None:
+        try:
+            asyncio.run_coroutine_threadsafe(backends.close(), loop).result(timeout=5)
+        except Exception as e:
+            logger.warning(f"Failed to close the asyncio engine sessions: {e}")
+
+
+def run(coroutine):
+    """Run a coroutine on the engine loop, in a copy of the caller's context, and return its result"""
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_loop()).result()
+
+
+def run_concurrently(func, items, max_in_flight):
+    """Await func(item) for each item on the engine loop, with at most max_in_flight coroutines in flight.
+
+    Items are pulled lazily off the loop so a blocking generator does not stall it, and (item, result, error) tuples
+    are yielded to the caller in completion order.
+    """
+    max_in_flight = max(1, max_in_flight)
+    outcomes = queue.Queue()
+    exhausted = object()
+
+    async def run_items():
+        items_iterator = iter(items)
+        tasks = {}
+        more_items = True
+
+        while tasks or more_items:
+            while more_items and len(tasks) < max_in_flight:
+                item = await asyncio.to_thread(next, items_iterator, exhausted)
+                if item is exhausted:
+                    more_items = False
+                    break
+                tasks[asyncio.create_task(func(item))] = item
+
+            if not tasks:
+                break
+
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                item = tasks.pop(task)
+                error = task.exception()
+                outcomes.put((item, None if error else task.result(), error))
+
+    async def run_all():
+        try:
+            await run_items()
+        except BaseException as e:
+            outcomes.put(e)
+        else:
+            outcomes.put(exhausted)
+
+    # The task of run_all() copies the caller's context, so spans opened by func nest under the caller's span
+    asyncio.run_coroutine_threadsafe(run_all(), _get_loop())
+
+    while True:
+        outcome = outcomes.get()
+        if outcome is exhausted:
+            return
+        if isinstance(outcome, BaseException):
+            raise outcome
+        yield outcome
+
+
+async def _find_keycloak_user_id(username):
+    users = await request('keycloak', 'GET', '/users',
+                          params={'username': username.lower(), 'max': 1, 'exact': 'true'})
+    return users[0]['id'] if len(users) == 1 else None
+
+
+@track_backend('keycloak', 'create')
+@traced('keycloak', 'create')
+async def create_keycloak_user(username, email):
+    generated_password = generate_password(username, datetime.now().year)
+
+    user_data = {
+        'email': email,
+        'enabled': True,
+        'username': username,
+        'credentials': [{'type': 'password', 'value': generated_password}],
+        'attributes': {
+            'managed-by': ['k8s-provisioner'],
+            'provisioned': ['true']
+        }
+    }
+
+    if await _find_keycloak_user_id(username):
+        return "CREATED"
+
+    # The id comes from the Location header of the creation response; a 409 means
+    # the user was created concurrently
+    try:
+        user_id = await request('keycloak', 'POST', '/users', json=user_data, location=True)
+    except BackendError as e:
+        if e.status_code == 409:
+            return "CREATED"
+        raise
+
+    return user_id, generated_password
+
+
+@track_backend('keycloak', 'delete')
+@traced('keycloak', 'delete')
+async def delete_keycloak_user(username):
+    user_id = await _find_keycloak_user_id(username)
+
+    if user_id:
+        await request('keycloak', 'DELETE', f'/users/{user_id}')
+
+    return user_id
+
+
+def _k8s_collection_path(manifest):
+    """API path of the collection a manifest is created in; the kinds of provisionner.yaml pluralize with an s"""
+    api_version = manifest['apiVersion']
+    path = f"/apis/{api_version}" if '/' in api_version else f"/api/{api_version}"
+
+    namespace = manifest['metadata'].get('namespace')
+    if namespace:
+        path += f"/namespaces/{namespace}"
+
+    return f"{path}/{manifest['kind'].lower()}s"
+
+
+async def _wait_for_namespace_termination(username):
+    """Wait until the informer sees a Terminating namespace deleted, as it cannot be created again before"""
+    deadline = time.monotonic() + K8S_NAMESPACE_TERMINATION_TIMEOUT
+    while is_namespace_terminating(username):
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Namespace {username} is still terminating")
+        await asyncio.sleep(1)
+
+
+@track_backend('k8s', 'apply')
+@traced('k8s', 'apply')
+async def apply_k8s_config(username, user_id):
+    await _wait_for_namespace_termination(username)
+
+    # In template order, the namespace first
+    for manifest in render_k8s_template(username, user_id):
+        with backend_span('k8s', 'create', username=username, resource_type=manifest.get('kind')):
+            await request('k8s', 'POST', _k8s_collection_path(manifest), json=manifest)
+
+    return True
+
+
+@track_backend('k8s', 'delete')
+@traced('k8s', 'delete')
+async def delete_k8s_namespace(username):
+    await request('k8s', 'DELETE', f'/api/v1/namespaces/{username}')
+
+    return True
+
+
+async def _is_namespace_resource_populated(username, resource):
+    """Check with a metadata-only listing whether a namespace holds at least one object of a type"""
+    with backend_span('k8s', 'list', username=username, resource_type=resource['name']):
+        response = await request(
+            'k8s', 'GET', f"{resource['prefix']}/namespaces/{username}/{resource['name']}",
+            params={'limit': 1},
+            headers={'Accept': 'application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1,application/json'})
+
+    return bool(response.get('items'))
+
+
+async def _delete_namespace_collection(username, resource):
+    with backend_span('k8s', 'deletecollection', username=username, resource_type=resource['name']):
+        await request('k8s', 'DELETE', f"{resource['prefix']}/namespaces/{username}/{resource['name']}",
+                      headers={'Accept': 'application/json'})
+
+
+@track_backend('k8s', 'reset')
+@traced('k8s', 'reset')
+async def delete_namespace_resources(username):
+    """Delete all resources in a namespace without deleting the namespace itself"""
+    resources = await asyncio.to_thread(get_namespaced_resources)
+    populated_resources = []
+    deleted_resources = []
+    failed_resources = []
+
+    # Find which resource types actually hold objects; types that cannot be listed are deleted blindly
+    listings = await asyncio.gather(*(_is_namespace_resource_populated(username, resource) for resource in resources),
+                                    return_exceptions=True)
+    for resource, populated in zip(resources, listings):
+        if isinstance(populated, Exception):
+            logger.warning(f"Failed to list {resource['name']} in namespace {username}: {populated}")
+        if populated:
+            populated_resources.append(resource)
+
+    # Delete every populated resource type in the namespace concurrently
+    deletions = await asyncio.gather(*(_delete_namespace_collection(username, resource)
+                                       for resource in populated_resources), return_exceptions=True)
+    for resource, error in zip(populated_resources, deletions):
+        if error is None:
+            deleted_resources.append(resource['name'])
+            logger.info(f"Deleted {resource['name']} in namespace {username}")
+        else:
+            logger.error(f"Failed to delete {resource['name']} in namespace {username}: {error}", exc_info=error)
+            failed_resources.append(resource['name'])
+
+    return {
+        'deleted_resources': deleted_resources,
+        'failed_resources': failed_resources
+    }
+
+
+@track_backend('grafana', 'create')
+@traced('grafana', 'create')
+async def create_grafana_user(username, email, password):
+    user = await request('grafana', 'POST', '/admin/users', json={
+        "name": username,
+        "email": email,
+        "login": username,
+        "password": password,
+        "role": "Viewer",
+        "OrgId": 1})
+
+    await asyncio.to_thread(cache_grafana_user, username, user.get('id'), email)
+    return user
+
+
+@track_backend('grafana', 'find')
+@traced('grafana', 'find')
+async def get_grafana_user(username):
+    """Get Grafana user by username, returns None if user doesn't exist"""
+    try:
+        # The directory misses users created since it was loaded, possibly by another process
+        return (await asyncio.to_thread(find_cached_grafana_user, username)
+                or await request('grafana', 'GET', '/users/lookup', params={'loginOrEmail': username}))
+    except Exception as e:
+        logger.debug(f"Grafana user {username} not found: {e}")
+        return None
+
+
+@track_backend('grafana', 'delete')
+@traced('grafana', 'delete')
+async def delete_grafana_user(username):
+    user = await asyncio.to_thread(find_cached_grafana_user, username)
+    if not user:
+        user = await request('grafana', 'GET', '/users/lookup', params={'loginOrEmail': username})
+
+    if user:
+        await request('grafana', 'DELETE', f"/admin/users/{user['id']}")
+
+    await asyncio.to_thread(forget_grafana_user, username)
+    return True
+
+
+async def teardown_user(username):
+    """Delete the namespace and Grafana account of a user concurrently, then its Keycloak identity.
+
+    Namespace and Grafana failures are logged only; the Keycloak user id is
+    returned and a Keycloak failure is raised.
+    """
+    logger.info(f"Cleaning up resources for user: {username}")
+
+    namespace_error, grafana_error = [
+        outcome if isinstance(outcome, Exception) else None
+        for outcome in await asyncio.gather(delete_k8s_namespace(username), delete_grafana_user(username),
+                                            return_exceptions=True)]
+
+    if namespace_error is None:
+        logger.info(f"Deleted namespace for user: {username}")
+    else:
+        logger.error(f"Failed to delete namespace for user {username}: {namespace_error}", exc_info=namespace_error)
+
+    if grafana_error is None:
+        logger.info(f"Deleted Grafana user: {username}")
+    else:
+        logger.error(f"Failed to delete Grafana user {username}: {grafana_error}", exc_info=grafana_error)
+
+    user_id = await delete_keycloak_user(username)
+    logger.info(f"Deleted Keycloak user: {username}")
+
+    return user_id
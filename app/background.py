@@ -0,0 +1,69 @@
+import os
+import time
+import fcntl
+import logging
+import threading
+
+from app import aio
+from app.utils import start_namespace_informer, reset_backend_clients
+from app.scheduler import start_scheduler
+from app.inventory import start_reconciler
+
+logger = logging.getLogger(__name__)
+
+# Lock file electing the one server process of the pod that runs the expiry scheduler and the inventory reconciler;
+# empty to run them in every process
+BACKGROUND_LOCK_FILE = os.environ.get('BACKGROUND_LOCK_FILE', '/tmp/k8s-provisioner-background.lock')
+# Seconds between two attempts of the other processes to take over the lock
+BACKGROUND_ELECTION_INTERVAL = 10
+
+_lock = threading.Lock()
+_election = None
+# Kept open for the life of the process: the lock is released when the process exits
+_lock_file = None
+
+
+def _start_singletons():
+    logger.info(f"Process {os.getpid()} runs the expiry scheduler and the inventory reconciler")
+    start_scheduler()
+    start_reconciler()
+
+
+def _run_election():
+    global _lock_file
+
+    _lock_file = open(BACKGROUND_LOCK_FILE, 'a')
+    while True:
+        try:
+            fcntl.flock(_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            time.sleep(BACKGROUND_ELECTION_INTERVAL)
+
+    _start_singletons()
+
+
+def start_background_threads():
+    """Start the namespace informer, and the scheduler and reconciler if this process wins the election"""
+    global _election
+
+    start_namespace_informer()
+
+    with _lock:
+        if _election is not None:
+            return
+
+        if not BACKGROUND_LOCK_FILE:
+            _election = True
+            _start_singletons()
+            return
+
+        _election = threading.Thread(target=_run_election, name='background-election', daemon=True)
+        _election.start()
+
+
+def init_worker():
+    """Prepare a freshly forked server process: rebuild the backend clients, then start its background threads"""
+    reset_backend_clients()
+    aio.reset_engine()
+    start_background_threads()
@@ -0,0 +1,84 @@
+import os
+import sqlite3
+import threading
+
+# SQLite file shared by the server processes, on the data volume of microservice.yaml; ':memory:' keeps it in the process
+INVENTORY_DB = os.environ.get('INVENTORY_DB', '/var/lib/k8s-provisioner/inventory.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    user_id TEXT,
+    email TEXT,
+    created_at REAL,
+    namespace_present INTEGER NOT NULL DEFAULT 0,
+    grafana_present INTEGER NOT NULL DEFAULT 0,
+    last_reset_at REAL,
+    reconciled_at REAL
+);
+CREATE INDEX IF NOT EXISTS users_created_at ON users (created_at);
+CREATE INDEX IF NOT EXISTS users_incomplete ON users (namespace_present, grafana_present);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value REAL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS grafana_users (
+    login TEXT PRIMARY KEY,
+    user_id INTEGER,
+    email TEXT,
+    saved_at REAL
+);
+CREATE INDEX IF NOT EXISTS grafana_users_email ON grafana_users (email);
+"""
+
+# Serializes the use of the connection by the threads of a process
+lock = threading.Lock()
+_connection = None
+
+
+def connect():
+    """Get the connection of this process, opening the database and creating its tables on first use"""
+    global _connection
+
+    if _connection is None:
+        if INVENTORY_DB != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(INVENTORY_DB)), exist_ok=True)
+        # Every server process opens the same file: wait for the other writers and let readers run alongside them
+        _connection = sqlite3.connect(INVENTORY_DB, check_same_thread=False, isolation_level=None, timeout=30)
+        if INVENTORY_DB != ':memory:':
+            _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.executescript(SCHEMA)
+
+    return _connection
+
+
+def write(statement, parameters=()):
+    with lock:
+        connect().execute(statement, parameters)
+
+
+def query(statement, parameters=()):
+    with lock:
+        return connect().execute(statement, parameters).fetchall()
+
+
+def run_in_transaction(statements):
+    """Run (statement, parameters) pairs in one transaction; executemany is used when parameters is a list"""
+    with lock:
+        connection = connect()
+        connection.execute("BEGIN")
+        try:
+            for statement, parameters in statements:
+                if isinstance(parameters, list):
+                    connection.executemany(statement, parameters)
+                else:
+                    connection.execute(statement, parameters)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
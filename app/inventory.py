@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from app import db
+from app.utils import iter_provisioned_users, list_provisioned_namespaces, list_grafana_logins, ProvisionedUser, \
+    USER_RETENTION
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two background reconciliations with Keycloak, Kubernetes and Grafana
+INVENTORY_RECONCILE_INTERVAL = int(os.environ.get('INVENTORY_RECONCILE_INTERVAL', 3600))
+# Older inventories are not trusted by the endpoints and get reconciled first
+INVENTORY_MAX_AGE = int(os.environ.get('INVENTORY_MAX_AGE', 2 * INVENTORY_RECONCILE_INTERVAL))
+
+_lock = threading.Lock()
+_reconciler = None
+
+
+def record_user(username, user_id, email, created_at=None):
+    """Record a freshly provisioned user, with its namespace and Grafana account present.
+
+    The row counts as reconciled now, so a reconciliation already listing the backends keeps it as written.
+    """
+    now = time.time()
+    db.write("""
+        INSERT INTO users (username, user_id, email, created_at, namespace_present, grafana_present, reconciled_at)
+        VALUES (?, ?, ?, ?, 1, 1, ?)
+        ON CONFLICT (username) DO UPDATE SET
+            user_id = excluded.user_id, email = excluded.email, created_at = excluded.created_at,
+            namespace_present = 1, grafana_present = 1, reconciled_at = excluded.reconciled_at
+    """, (username, user_id, email, now if created_at is None else created_at, now))
+
+
+def remove_user(username):
+    db.write("DELETE FROM users WHERE username = ?", (username,))
+
+
+def mark_reset(username):
+    db.write("UPDATE users SET last_reset_at = ? WHERE username = ?", (time.time(), username))
+
+
+def mark_present(username, namespace=False, grafana=False):
+    """Flag the namespace and/or Grafana account of a user as existing"""
+    if namespace:
+        db.write("UPDATE users SET namespace_present = 1, reconciled_at = ? WHERE username = ?",
+                 (time.time(), username))
+    if grafana:
+        db.write("UPDATE users SET grafana_present = 1, reconciled_at = ? WHERE username = ?",
+                 (time.time(), username))
+
+
+def reconcile(refresh=False):
+    """Refresh the inventory from the Keycloak user stream and the namespace and Grafana listings.
+
+    The Grafana listing comes from the directory cache, reloaded first when refresh is set. Rows written by the
+    endpoints after the listings started are newer than them and are neither overwritten nor deleted.
+    """
+    started_at = time.time()
+    namespaces = list_provisioned_namespaces()
+    grafana_logins = list_grafana_logins(refresh)
+
+    # Listed before taking the lock, so the writes of the endpoints do not wait for the Keycloak pages
+    rows = [(user.username, user.id, user.email, user.created_at,
+             user.username in namespaces, user.username in grafana_logins, started_at)
+            for user in iter_provisioned_users() if user.username]
+
+    db.run_in_transaction([
+        ("""
+            INSERT INTO users (username, user_id, email, created_at, namespace_present, grafana_present, reconciled_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (username) DO UPDATE SET
+                user_id = excluded.user_id, email = excluded.email, created_at = excluded.created_at,
+                namespace_present = excluded.namespace_present, grafana_present = excluded.grafana_present,
+                reconciled_at = excluded.reconciled_at
+            WHERE users.reconciled_at IS NULL OR users.reconciled_at < excluded.reconciled_at
+        """, rows),
+        ("DELETE FROM users WHERE reconciled_at IS NULL OR reconciled_at < ?", (started_at,)),
+        ("INSERT OR REPLACE INTO meta (key, value) VALUES ('reconciled_at', ?)", (started_at,)),
+    ])
+
+    logger.info("Inventory reconciled")
+
+
+def is_fresh():
+    """Whether the inventory has been reconciled within INVENTORY_MAX_AGE"""
+    rows = db.query("SELECT value FROM meta WHERE key = 'reconciled_at'")
+
+    return bool(rows) and time.time() - rows[0][0] < INVENTORY_MAX_AGE
+
+
+def ensure_fresh():
+    if not is_fresh():
+        reconcile()
+
+
+def _query_users(statement, parameters=()):
+    rows = db.query(statement, parameters)
+
+    return [ProvisionedUser(user_id, username, email, created_at) for username, user_id, email, created_at in rows]
+
+
+def get_users():
+    return _query_users("SELECT username, user_id, email, created_at FROM users ORDER BY username")
+
+
+def get_expired_users(now=None):
+    """Get the users whose retention period has ended, oldest first, from the created_at index"""
+    ensure_fresh()
+    if now is None:
+        now = time.time()
+
+    return _query_users("SELECT username, user_id, email, created_at FROM users WHERE created_at < ? ORDER BY created_at",
+                        (now - USER_RETENTION.total_seconds(),))
+
+
+def get_incomplete_users():
+    """Get the users missing their namespace or Grafana account, with the flags of what exists"""
+    rows = db.query("""
+        SELECT username, user_id, email, created_at, namespace_present, grafana_present
+        FROM users WHERE namespace_present = 0 OR grafana_present = 0
+        ORDER BY username
+    """)
+
+    return [(ProvisionedUser(user_id, username, email, created_at), bool(namespace_present), bool(grafana_present))
+            for username, user_id, email, created_at, namespace_present, grafana_present in rows]
+
+
+def count_users():
+    return db.query("SELECT COUNT(*) FROM users")[0][0]
+
+
+def save_job(job_id, state, finished_at=None):
+    """Store the state of a background job, so any server process can answer GET /jobs/<id>"""
+    db.write("INSERT OR REPLACE INTO jobs (job_id, state, finished_at) VALUES (?, ?, ?)",
+             (job_id, json.dumps(state), finished_at))
+
+
+def load_job(job_id):
+    rows = db.query("SELECT state FROM jobs WHERE job_id = ?", (job_id,))
+
+    return json.loads(rows[0][0]) if rows else None
+
+
+def prune_jobs(finished_before):
+    db.write("DELETE FROM jobs WHERE finished_at < ?", (finished_before,))
+
+
+def _reconcile_forever():
+    while True:
+        try:
+            reconcile()
+        except Exception as e:
+            logger.error(f"Failed to reconcile inventory: {e}", exc_info=True)
+        time.sleep(INVENTORY_RECONCILE_INTERVAL)
+
+
+def start_reconciler():
+    """Start the background reconciliation thread once per process"""
+    global _reconciler
+
+    with _lock:
+        if _reconciler is not None:
+            return
+        _reconciler = threading.Thread(target=_reconcile_forever, name='inventory-reconciler', daemon=True)
+        _reconciler.start()
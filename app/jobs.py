@@ -0,0 +1,209 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from app import inventory
+from app.tracing import tracer, submit_in_context
+
+logger = logging.getLogger(__name__)
+
+# Number of bulk operations that can run in the background at the same time
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+# Seconds a finished job stays available on GET /jobs/<id>
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 86400))
+# Least seconds between two saves of the progress of a running job
+JOB_SAVE_INTERVAL = 1
+
+_jobs = {}
+# Future -> Job of the jobs submitted to this process and not finished yet
+_running = {}
+_jobs_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+
+
+class Job:
+    """Progress and outcome of a bulk operation running in the background"""
+
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = 'pending'
+        self.total = None
+        self.processed = 0
+        self.failed = 0
+        self.current_user = None
+        self.result = None
+        self.status_code = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._saved_at = 0
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self.status = 'running'
+        self.save()
+
+    def start(self, total):
+        """Record the number of users to process, when it is known upfront"""
+        with self._lock:
+            self.total = total
+        self.save()
+
+    def advance(self, username, failed=False):
+        with self._lock:
+            self.processed += 1
+            if failed:
+                self.failed += 1
+            self.current_user = username
+        self.save(force=False)
+
+    def finish(self, result, status_code):
+        """Record the outcome of the job, unless it already has one"""
+        with self._lock:
+            if self.finished_at is not None:
+                return
+            self.result = result
+            self.status_code = status_code
+            self.status = 'succeeded' if status_code < 400 else 'failed'
+            if self.total is None:
+                self.total = self.processed
+            self.current_user = None
+            self.finished_at = time.time()
+        self.save()
+
+    def save(self, force=True):
+        """Store the job state in the inventory; progress updates are throttled to one per JOB_SAVE_INTERVAL"""
+        now = time.time()
+        if not force and now - self._saved_at < JOB_SAVE_INTERVAL:
+            return
+        self._saved_at = now
+
+        try:
+            inventory.save_job(self.id, self.to_dict(), self.finished_at)
+        except Exception as e:
+            logger.warning(f"Failed to save the state of job {self.id}: {e}")
+
+    def forget_passwords(self):
+        with self._lock:
+            self.result = without_passwords(self.result)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'job_id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'total': self.total,
+                'processed': self.processed,
+                'failed': self.failed,
+                'current_user': self.current_user,
+                'result': self.result,
+                'created_at': self.created_at,
+                'finished_at': self.finished_at
+            }
+
+
+def without_passwords(result):
+    """Copy of a job result without the passwords of the users it provisioned"""
+    if not isinstance(result, dict) or not isinstance(result.get('results'), list):
+        return result
+
+    return dict(result, results=[{key: value for key, value in user.items() if key != 'password'}
+                                 for user in result['results']])
+
+
+def _run_job(job, func):
+    job.begin()
+    try:
+        with tracer.start_as_current_span(f"job-{job.kind}", attributes={'provisioner.job_id': job.id}):
+            result, status_code = func(job)
+    except Exception as e:
+        logger.error(f"Job {job.id} ({job.kind}) failed: {e}", exc_info=True)
+        result, status_code = {'message': f'Job failed: {e}'}, 500
+    job.finish(result, status_code)
+
+
+def _prune_jobs():
+    expired_before = time.time() - JOB_RETENTION
+    with _jobs_lock:
+        for job_id in [job_id for job_id, job in _jobs.items()
+                       if job.finished_at and job.finished_at < expired_before]:
+            del _jobs[job_id]
+
+    try:
+        inventory.prune_jobs(expired_before)
+    except Exception as e:
+        logger.warning(f"Failed to prune finished jobs: {e}")
+
+
+def _forget_future(future):
+    with _jobs_lock:
+        _running.pop(future, None)
+
+
+def submit_job(kind, func):
+    """Run func(job) on the background executor; func returns a (body, status_code) pair"""
+    _prune_jobs()
+
+    job = Job(kind)
+    with _jobs_lock:
+        _jobs[job.id] = job
+    job.save()
+
+    future = submit_in_context(_executor, _run_job, job, func)
+    with _jobs_lock:
+        _running[future] = job
+    future.add_done_callback(_forget_future)
+    return job
+
+
+def get_job(job_id):
+    """Get the state of a job submitted to any server process, or None.
+
+    The passwords in the result of a finished job are only returned once, then dropped from the stored state.
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+
+    state = job.to_dict() if job is not None else inventory.load_job(job_id)
+    if state is None or state['finished_at'] is None:
+        return state
+
+    redacted = without_passwords(state['result'])
+    if redacted != state['result']:
+        if job is not None:
+            job.forget_passwords()
+        try:
+            inventory.save_job(job_id, dict(state, result=redacted), state['finished_at'])
+        except Exception as e:
+            logger.warning(f"Failed to drop the passwords of job {job_id}: {e}")
+    return state
+
+
+def drain(timeout):
+    """Cancel the jobs of this process that have not started, then wait up to timeout seconds for the running ones.
+
+    Jobs still running after timeout are failed so pollers stop waiting, as the process is killed soon after.
+    """
+    with _jobs_lock:
+        submitted = dict(_running)
+
+    running = {}
+    for future, job in submitted.items():
+        # Only a job still queued can be cancelled; a running one keeps its thread until it returns
+        if future.cancel():
+            job.finish({'message': 'Job cancelled by a server shutdown'}, 503)
+        else:
+            running[future] = job
+
+    if not running:
+        return
+
+    logger.info(f"Waiting up to {timeout}s for {len(running)} background jobs")
+    _, not_done = wait(running, timeout=timeout)
+    for future in not_done:
+        running[future].finish({'message': 'Job interrupted by a server shutdown'}, 503)
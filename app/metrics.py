@@ -0,0 +1,115 @@
+import os
+import time
+import inspect
+import functools
+from contextlib import ContextDecorator
+
+from flask import request, g
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, \
+    multiprocess, CONTENT_TYPE_LATEST
+
+# Directory where the processes of a multi-process server share their metrics (set by gunicorn.conf.py)
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+BACKEND_LATENCY = Histogram(
+    'provisioner_backend_operation_seconds',
+    'Duration of Keycloak, Kubernetes and Grafana operations',
+    ['backend', 'operation'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+BACKEND_ERRORS = Counter(
+    'provisioner_backend_errors_total',
+    'Keycloak, Kubernetes and Grafana operations that raised an error',
+    ['backend', 'operation']
+)
+REQUEST_LATENCY = Histogram(
+    'provisioner_http_request_seconds',
+    'Duration of HTTP requests per endpoint',
+    ['method', 'endpoint', 'status'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'provisioner_http_requests_in_flight',
+    'HTTP requests being processed per endpoint',
+    ['method', 'endpoint'],
+    multiprocess_mode='livesum'
+)
+
+
+class track_backend(ContextDecorator):
+    """Record the duration and errors of a backend operation, as a decorator of functions or coroutines,
+    or as a context manager"""
+
+    def __init__(self, backend, operation):
+        self.backend = backend
+        self.operation = operation
+
+    def _recreate_cm(self):
+        # A fresh timer per decorated call, so concurrent calls do not share a start time
+        return track_backend(self.backend, self.operation)
+
+    def __call__(self, func):
+        if not inspect.iscoroutinefunction(func):
+            return super().__call__(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with self._recreate_cm():
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        BACKEND_LATENCY.labels(self.backend, self.operation).observe(time.perf_counter() - self._started_at)
+        if exc_type is not None:
+            BACKEND_ERRORS.labels(self.backend, self.operation).inc()
+        return False
+
+
+def _endpoint():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def _before_request():
+    g.metrics_started_at = time.perf_counter()
+    REQUESTS_IN_FLIGHT.labels(request.method, _endpoint()).inc()
+
+
+def _after_request(response):
+    started_at = g.pop('metrics_started_at', None)
+    if started_at is not None:
+        REQUESTS_IN_FLIGHT.labels(request.method, _endpoint()).dec()
+        REQUEST_LATENCY.labels(request.method, _endpoint(), response.status_code).observe(
+            time.perf_counter() - started_at)
+    return response
+
+
+def _registry():
+    """The default registry, or one aggregating every server process in multi-process mode"""
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def metrics_view():
+    return generate_latest(_registry()), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+
+def mark_process_dead(pid):
+    """Drop the live gauges of an exited server process"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+def init_app(app):
+    """Time every request of the Flask app and expose the registry on GET /metrics"""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,121 @@
+import os
+import time
+import heapq
+import logging
+import threading
+
+from app import aio, inventory
+from app.utils import USER_RETENTION
+
+logger = logging.getLogger(__name__)
+
+# Run the in-process expiry scheduler when the server starts
+EXPIRY_SCHEDULER_ENABLED = os.environ.get('EXPIRY_SCHEDULER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Seconds to wait before retrying a teardown that failed
+EXPIRY_RETRY_DELAY = int(os.environ.get('EXPIRY_RETRY_DELAY', 3600))
+# Seconds between two reloads of the users from the inventory, picking up the users provisioned by other processes
+EXPIRY_RESCAN_INTERVAL = int(os.environ.get('EXPIRY_RESCAN_INTERVAL', 86400))
+# Longest sleep between two checks, so clock jumps are caught up quickly
+EXPIRY_MAX_SLEEP = 600
+
+_condition = threading.Condition()
+# Min-heap of (expires_at, username); entries no longer matching _scheduled are skipped when popped
+_heap = []
+_scheduled = {}
+_thread = None
+
+
+def schedule_user(username, expires_at):
+    """Tear the user down at expires_at (epoch seconds), replacing any earlier schedule"""
+    with _condition:
+        # Only the process running the scheduler keeps a heap; the others leave it to its next rescan
+        if _thread is None:
+            return
+        _scheduled[username] = expires_at
+        heapq.heappush(_heap, (expires_at, username))
+        _condition.notify()
+
+
+def unschedule_user(username):
+    with _condition:
+        _scheduled.pop(username, None)
+
+
+def schedule_new_user(username):
+    schedule_user(username, time.time() + USER_RETENTION.total_seconds())
+
+
+def _rebuild():
+    """Load the schedule from the inventory, keeping pending retries, and rebuild the heap without stale entries"""
+    global _heap, _scheduled
+
+    inventory.ensure_fresh()
+    retention = USER_RETENTION.total_seconds()
+    users = inventory.get_users()
+
+    with _condition:
+        _scheduled = {user.username: _scheduled.get(user.username, user.created_at + retention)
+                      for user in users if user.username}
+        _heap = [(expires_at, username) for username, expires_at in _scheduled.items()]
+        heapq.heapify(_heap)
+        _condition.notify()
+
+    logger.info(f"Expiry scheduler tracking {len(_scheduled)} users")
+
+
+def _next_due_user(until):
+    """Block until a scheduled user expires and return its username, or None once until (epoch seconds) passes"""
+    with _condition:
+        while True:
+            now = time.time()
+            while _heap and _scheduled.get(_heap[0][1]) != _heap[0][0]:
+                heapq.heappop(_heap)
+
+            if _heap and _heap[0][0] <= now:
+                _, username = heapq.heappop(_heap)
+                del _scheduled[username]
+                return username
+
+            if now >= until:
+                return None
+
+            timeout = min(_heap[0][0] - now, EXPIRY_MAX_SLEEP) if _heap else EXPIRY_MAX_SLEEP
+            _condition.wait(min(timeout, until - now))
+
+
+def _teardown_expired_user(username):
+    try:
+        user_id = aio.run(aio.teardown_user(username))
+        inventory.remove_user(username)
+        logger.info(f"Expired user {username} ({user_id}) has been deleted")
+    except Exception as e:
+        logger.error(f"Failed to delete expired user {username}: {e}", exc_info=True)
+        schedule_user(username, time.time() + EXPIRY_RETRY_DELAY)
+
+
+def _run():
+    while True:
+        try:
+            _rebuild()
+        except Exception as e:
+            logger.error(f"Failed to load users into the expiry scheduler: {e}", exc_info=True)
+
+        rescan_at = time.time() + EXPIRY_RESCAN_INTERVAL
+        username = _next_due_user(rescan_at)
+        while username is not None:
+            _teardown_expired_user(username)
+            username = _next_due_user(rescan_at)
+
+
+def start_scheduler():
+    """Start the expiry scheduler thread once per process, if enabled"""
+    global _thread
+
+    if not EXPIRY_SCHEDULER_ENABLED:
+        return
+
+    with _condition:
+        if _thread is not None:
+            return
+        _thread = threading.Thread(target=_run, name='expiry-scheduler', daemon=True)
+        _thread.start()
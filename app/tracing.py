@@ -0,0 +1,160 @@
+import inspect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+import aiohttp
+from opentelemetry import trace
+
+tracer = trace.get_tracer(__name__)
+
+# HTTP calls made inside the innermost backend span of the current context
+_current_calls = contextvars.ContextVar('backend_calls', default=None)
+
+
+class _BackendCalls:
+    """HTTP calls counted for a backend span, also credited to its enclosing backend spans"""
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.requests = 0
+        self.retries = 0
+        self.status_code = None
+        self._lock = threading.Lock()
+
+    def record(self, status_code, retries):
+        calls = self
+        while calls is not None:
+            with calls._lock:
+                calls.requests += 1
+                calls.retries += retries
+                if status_code is not None:
+                    calls.status_code = status_code
+            calls = calls.parent
+
+
+def _error_status_code(error):
+    """HTTP status carried by a Kubernetes, Keycloak or Grafana client error, if any"""
+    for attribute in ('status', 'response_code', 'status_code'):
+        status_code = getattr(error, attribute, None)
+        if isinstance(status_code, int):
+            return status_code
+    return None
+
+
+@contextmanager
+def backend_span(backend, operation, username=None, resource_type=None):
+    """Trace a backend operation, recording the HTTP status and retries of the calls it makes"""
+    attributes = {'provisioner.backend': backend, 'provisioner.operation': operation}
+    if username:
+        attributes['provisioner.username'] = username
+    if resource_type:
+        attributes['provisioner.resource_type'] = resource_type
+
+    calls = _BackendCalls(_current_calls.get())
+    token = _current_calls.set(calls)
+    try:
+        with tracer.start_as_current_span(f"{backend}.{operation}", attributes=attributes) as span:
+            try:
+                yield span
+            except Exception as e:
+                status_code = _error_status_code(e)
+                if status_code is not None:
+                    calls.status_code = status_code
+                raise
+            finally:
+                if calls.status_code is not None:
+                    span.set_attribute('http.status_code', calls.status_code)
+                span.set_attribute('http.request_count', calls.requests)
+                span.set_attribute('http.retry_count', calls.retries)
+    finally:
+        _current_calls.reset(token)
+
+
+def traced(backend, operation):
+    """Run the decorated helper or coroutine inside a backend span, tagged with its username argument"""
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                username = signature.bind_partial(*args, **kwargs).arguments.get('username')
+                with backend_span(backend, operation, username=username):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            username = signature.bind_partial(*args, **kwargs).arguments.get('username')
+            with backend_span(backend, operation, username=username):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def user_span(operation, username):
+    """Trace the processing of one user by a bulk operation"""
+    attributes = {'provisioner.username': username} if username else {}
+    with tracer.start_as_current_span(operation, attributes=attributes) as span:
+        yield span
+
+
+def record_http_call(status_code, retries=0):
+    calls = _current_calls.get()
+    if calls is not None:
+        calls.record(status_code, retries)
+
+
+def _retry_count(retries):
+    return len(retries.history) if retries is not None and retries.history else 0
+
+
+def _record_requests_response(response, *args, **kwargs):
+    record_http_call(response.status_code, _retry_count(getattr(response.raw, 'retries', None)))
+
+
+def instrument_session(session):
+    """Record the status and retries of every response of a requests session on the current backend span"""
+    session.hooks['response'].append(_record_requests_response)
+
+
+async def _record_aiohttp_response(session, context, params):
+    record_http_call(params.response.status)
+
+
+def aiohttp_trace_config():
+    """aiohttp TraceConfig recording the status of every response of a session on the current backend span"""
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_end.append(_record_aiohttp_response)
+    return trace_config
+
+
+def instrument_k8s_client(api_client):
+    """Record the status and retries of every call of a Kubernetes ApiClient on the current backend span"""
+    rest_client = api_client.rest_client
+    request = rest_client.request
+
+    @functools.wraps(request)
+    def traced_request(*args, **kwargs):
+        try:
+            response = request(*args, **kwargs)
+        except Exception as e:
+            record_http_call(_error_status_code(e))
+            raise
+        # Watches and other unbuffered calls get the raw urllib3 response rather than a RESTResponse
+        urllib3_response = getattr(response, 'urllib3_response', response)
+        record_http_call(response.status, _retry_count(getattr(urllib3_response, 'retries', None)))
+        return response
+
+    rest_client.request = traced_request
+
+
+def submit_in_context(executor, func, *args):
+    """Submit func to an executor in a copy of the caller's context, so its spans keep their parent"""
+    return executor.submit(contextvars.copy_context().run, func, *args)
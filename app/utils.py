@@ -1,41 +1,114 @@
+import copy
 import json
 import os
 import random
 import string
 import logging
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 import yaml
 from dotenv import load_dotenv
 from grafana_client import GrafanaApi
-from keycloak import KeycloakAdmin
-from kubernetes import client, config, utils
+from keycloak import KeycloakAdmin, KeycloakOpenIDConnection
+from kubernetes import client, config, watch
+from requests.adapters import HTTPAdapter
 from slugify import slugify
 
+from app import db
+from app.metrics import track_backend
+from app.tracing import traced, backend_span, instrument_session, instrument_k8s_client, submit_in_context
+
 load_dotenv("/vault/secrets/config")
 load_dotenv(".env")
 
 logger = logging.getLogger(__name__)
 
+# Size of the keep-alive connection pool shared by every Keycloak call
+KEYCLOAK_POOL_SIZE = int(os.environ.get('KEYCLOAK_POOL_SIZE', 16))
+# Refresh the service-account token this many seconds before it expires
+KEYCLOAK_TOKEN_REFRESH_MARGIN = int(os.environ.get('KEYCLOAK_TOKEN_REFRESH_MARGIN', 30))
+
+# How long a provisioned user is kept before POST /cleanup removes it
+USER_RETENTION = timedelta(days=int(os.environ.get('USER_RETENTION_DAYS', 365)))
+
+# Number of users fetched per Keycloak request when listing provisioned users
+KEYCLOAK_PAGE_SIZE = int(os.environ.get('KEYCLOAK_PAGE_SIZE', 500))
+
+# Size of the urllib3 pool behind the shared Kubernetes ApiClient
+K8S_POOL_SIZE = int(os.environ.get('K8S_POOL_SIZE', 16))
+
+# Size of the keep-alive connection pool of the Grafana client
+GRAFANA_POOL_SIZE = int(os.environ.get('GRAFANA_POOL_SIZE', 4))
+
+_keycloak_admin = None
+_keycloak_lock = threading.Lock()
+
+# How long the list of namespaced API resources is trusted before rediscovery
+K8S_DISCOVERY_TTL = int(os.environ.get('K8S_DISCOVERY_TTL', 3600))
+# Optional JSON file used to persist the discovery result across restarts
+K8S_DISCOVERY_CACHE_FILE = os.environ.get('K8S_DISCOVERY_CACHE_FILE')
+
+# Resource kinds kept when a namespace is reset
+K8S_RESET_EXCLUDED_KINDS = ['resourcequota', 'rolebinding']
+
+_k8s_api_client = None
+_k8s_lock = threading.Lock()
+
+_k8s_discovery = None
+_k8s_discovery_lock = threading.Lock()
+
+# Label selecting the namespaces created from provisionner.yaml
+K8S_MANAGED_LABEL_SELECTOR = 'managed-by=k8s-provisioner'
+
+# name -> (phase, resourceVersion) of the managed namespaces, kept current by the informer
+_namespace_cache = {}
+_namespace_cache_synced = False
+_namespace_cache_lock = threading.Lock()
+_namespace_informer = None
+# Seconds a namespace being deleted is waited for before the same namespace is created again
+K8S_NAMESPACE_TERMINATION_TIMEOUT = int(os.environ.get('K8S_NAMESPACE_TERMINATION_TIMEOUT', 120))
+
+K8S_TEMPLATE_FILE = os.path.join(os.path.dirname(__file__), 'k8s_templates', 'provisionner.yaml')
+K8S_TEMPLATE_PLACEHOLDERS = ('username', 'user_id')
+
+# Grafana instance holding the sandbox accounts
+GRAFANA_URL = os.environ.get('GRAFANA_URL', 'https://grafana.zerofiltre.tech')
+
+# How long the prefetched Grafana user directory is trusted before it is reloaded
+GRAFANA_DIRECTORY_TTL = int(os.environ.get('GRAFANA_DIRECTORY_TTL', 300))
+
+# The directory lives in the grafana_users table of the shared database, so every server process sees the users
+# created and deleted by the others; this lock only keeps the threads of a process from reloading it together
+_grafana_directory_lock = threading.Lock()
 
 grafana = GrafanaApi.from_url(
-    url="https://grafana.zerofiltre.tech",
+    url=GRAFANA_URL,
     credential=(os.environ.get('GRAFANA_USER'), os.environ.get('GRAFANA_PASSWORD'))
 )
 
+# Keep enough keep-alive connections for every concurrent Grafana call
+for _protocol in ('https://', 'http://'):
+    grafana.client.s.mount(_protocol, HTTPAdapter(
+        pool_connections=GRAFANA_POOL_SIZE,
+        pool_maxsize=GRAFANA_POOL_SIZE
+    ))
+instrument_session(grafana.client.s)
+
 
 def generate_password(username, year):
     return '{}@{}'.format(username, year)
 
 
-def get_keycloak_admin():
-    """Get a configured KeycloakAdmin client"""
+def _build_keycloak_admin():
     KEYCLOAK_BASE_URL = os.environ.get('KEYCLOAK_BASE_URL')
     REALM = os.environ.get('KEYCLOAK_REALM')
     CLIENT_ID = os.environ.get('KEYCLOAK_CLIENT_ID')
     CLIENT_SECRET = os.environ.get('KEYCLOAK_CLIENT_SECRET')
 
-    return KeycloakAdmin(
+    connection = KeycloakOpenIDConnection(
         server_url=KEYCLOAK_BASE_URL,
         client_id=CLIENT_ID,
         client_secret_key=CLIENT_SECRET,
@@ -43,165 +116,282 @@ def get_keycloak_admin():
         verify=True
     )
 
+    # Replace the default adapters with larger pools, keeping their retry policy
+    for protocol, adapter in list(connection._s.adapters.items()):
+        connection._s.mount(protocol, HTTPAdapter(
+            pool_connections=KEYCLOAK_POOL_SIZE,
+            pool_maxsize=KEYCLOAK_POOL_SIZE,
+            max_retries=adapter.max_retries
+        ))
+    instrument_session(connection._s)
 
-def create_keycloak_user(username, email):
-    keycloak_admin = get_keycloak_admin()
-    current_year = datetime.now().year
-    generated_password = generate_password(username, current_year)
-
-    user_data = {
-        'email': email,
-        'enabled': True,
-        'username': username,
-        'credentials': [{'type': 'password', 'value': generated_password}],
-        'attributes': {
-            'managed-by': ['k8s-provisioner'],
-            'provisioned': ['true']
-        }
-    }
+    return KeycloakAdmin(connection=connection)
 
-    user_id = keycloak_admin.get_user_id(username)
 
-    if not user_id:
-        keycloak_admin.create_user(user_data, exist_ok=True)
-    else:
-        return "CREATED"
+def get_keycloak_admin():
+    """Get the process-wide KeycloakAdmin client, refreshing its token shortly before expiry"""
+    global _keycloak_admin
 
-    user_id = keycloak_admin.get_user_id(username)
-    return user_id, generated_password
+    with _keycloak_lock:
+        if _keycloak_admin is None:
+            _keycloak_admin = _build_keycloak_admin()
 
+        connection = _keycloak_admin.connection
+        refresh_at = connection.expires_at - timedelta(seconds=KEYCLOAK_TOKEN_REFRESH_MARGIN)
+        if datetime.now() >= refresh_at:
+            connection.refresh_token()
 
-def delete_keycloak_user(username):
-    KEYCLOAK_BASE_URL = os.environ.get('KEYCLOAK_BASE_URL')
-    REALM = os.environ.get('KEYCLOAK_REALM')
-    CLIENT_ID = os.environ.get('KEYCLOAK_CLIENT_ID')
-    CLIENT_SECRET = os.environ.get('KEYCLOAK_CLIENT_SECRET')
+        return _keycloak_admin
 
-    keycloak_admin = KeycloakAdmin(
-        server_url=KEYCLOAK_BASE_URL,
-        client_id=CLIENT_ID,
-        client_secret_key=CLIENT_SECRET,
-        realm_name=REALM,
-        verify=True
-    )
 
-    user_id = keycloak_admin.get_user_id(username)
+def reset_keycloak_admin():
+    """Drop the shared KeycloakAdmin client so the next call builds a fresh one"""
+    global _keycloak_admin
 
-    if user_id:
-        keycloak_admin.delete_user(user_id)
+    with _keycloak_lock:
+        _keycloak_admin = None
 
-    return user_id
 
+def get_k8s_api_client():
+    """Get the process-wide Kubernetes ApiClient, loading KUBE_CONFIG on first use"""
+    global _k8s_api_client
 
-def apply_k8s_config(username, user_id):
-    k8s_file = 'app/k8s_templates/provisionner.yaml'
+    with _k8s_lock:
+        if _k8s_api_client is None:
+            configuration = client.Configuration()
+            config.load_kube_config_from_dict(
+                json.loads(os.environ.get('KUBE_CONFIG')),
+                client_configuration=configuration)
+            configuration.connection_pool_maxsize = K8S_POOL_SIZE
+            _k8s_api_client = client.ApiClient(configuration)
+            instrument_k8s_client(_k8s_api_client)
 
-    template = None
+        return _k8s_api_client
 
-    with open(k8s_file) as f:
-        template = f.read()
 
-    template = template.replace("username", username)
-    template = template.replace("user_id", user_id)
+def reset_k8s_api_client():
+    """Drop the shared Kubernetes ApiClient so the next call reloads KUBE_CONFIG"""
+    global _k8s_api_client
 
-    templates = yaml.safe_load_all(template)
+    with _k8s_lock:
+        _k8s_api_client = None
 
-    config.load_kube_config_from_dict(
-        json.loads(os.environ.get('KUBE_CONFIG')))
 
-    for template in templates:
-        k8s_client = client.ApiClient()
+def reset_backend_clients():
+    """Drop the Keycloak and Kubernetes clients and the pooled Grafana connections, e.g. in a forked process"""
+    reset_keycloak_admin()
+    reset_k8s_api_client()
+    grafana.client.s.close()
 
-        utils.create_from_dict(k8s_client, template)
 
-    return True
+def get_core_v1_api():
+    return client.CoreV1Api(get_k8s_api_client())
 
 
-def delete_k8s_namespace(username):
-    config.load_kube_config_from_dict(
-        json.loads(os.environ.get('KUBE_CONFIG')))
+def _compile_k8s_template(path):
+    """Parse the provisioning template once and record where each placeholder is used.
 
-    with client.ApiClient() as api_client:
-        api_instance = client.CoreV1Api(api_client)
-        api_instance.delete_namespace(username)
+    A slot is a scalar that is exactly a placeholder, or a URL ending in
+    '#<placeholder>' such as the RoleBinding subject, so other occurrences of
+    the words are left untouched.
+    """
+    with open(path) as f:
+        documents = [document for document in yaml.safe_load_all(f) if document]
 
-    return True
+    slots = []
 
+    def walk(node, route):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                walk(value, route + (key,))
+        elif isinstance(node, list):
+            for index, value in enumerate(node):
+                walk(value, route + (index,))
+        elif isinstance(node, str):
+            for placeholder in K8S_TEMPLATE_PLACEHOLDERS:
+                if node == placeholder or node.endswith('#' + placeholder):
+                    slots.append((route, placeholder, node[:-len(placeholder)]))
 
-def delete_namespace_resources(username):
-    """Delete all resources in a namespace without deleting the namespace itself"""
-    config.load_kube_config_from_dict(
-        json.loads(os.environ.get('KUBE_CONFIG')))
+    for index, document in enumerate(documents):
+        walk(document, (index,))
 
-    with client.ApiClient() as api_client:
-        # Get all API resources using the discovery API
-        v1 = client.CoreV1Api(api_client)
-        api_resources = v1.get_api_resources()
-        deleted_resources = []
-        failed_resources = []
+    return documents, slots
 
-        # Resources to exclude from deletion
-        excluded_resources = ['resourcequota', 'rolebinding']
-        
-        # For each namespaced resource, delete all instances in the namespace
-        for resource in api_resources.resources:
-            if resource.namespaced and resource.name.lower() not in excluded_resources:
-                try:
-                    # Construct the API path
-                    if resource.group:
-                        # For resources with API group
-                        api_path = f"/apis/{resource.group}/{resource.version}/namespaces/{username}/{resource.name}"
-                    else:
-                        # For core resources
-                        api_path = f"/api/v1/namespaces/{username}/{resource.name}"
 
-                    # Delete all resources of this type in the namespace
-                    api_call_kwargs = {
-                        "resource_path": api_path,
-                        "method": "DELETE",
-                        "response_type": "object",
-                    }
-                    response = api_client.call_api(**api_call_kwargs)
-                    deleted_resources.append(resource.name)
-                    logger.info(f"Deleted {resource.name} in namespace {username}")
-                except Exception as e:
-                    logger.error(f"Failed to delete {resource.name} in namespace {username}: {e}", exc_info=True)
-                    failed_resources.append(resource.name)
+def render_k8s_template(username, user_id):
+    """Build the manifests of a user from the precompiled provisioning template"""
+    documents = copy.deepcopy(_k8s_documents)
+    values = {'username': username, 'user_id': user_id}
 
-        return {
-            'deleted_resources': deleted_resources,
-            'failed_resources': failed_resources
-        }
+    for route, placeholder, prefix in _k8s_slots:
+        node = documents
+        for key in route[:-1]:
+            node = node[key]
+        node[route[-1]] = prefix + values[placeholder]
 
+    return documents
 
-def create_grafana_user(username, email, password):
-    user = grafana.admin.create_user({
-        "name": username,
-        "email": email,
-        "login": username,
-        "password": password,
-        "role": "Viewer",
-        "OrgId": 1})
 
-    return user
+_k8s_documents, _k8s_slots = _compile_k8s_template(K8S_TEMPLATE_FILE)
 
 
-def delete_grafana_user(username):
-    user = grafana.users.find_user(username)
+@traced('k8s', 'discover')
+def _discover_namespaced_resources():
+    """List every namespaced resource type that supports deletecollection, across all API groups"""
+    api_client = get_k8s_api_client()
 
-    if user:
-        grafana.admin.delete_user(user['id'])
+    resource_lists = [('/api/v1', get_core_v1_api().get_api_resources())]
+    for group in client.ApisApi(api_client).get_api_versions().groups:
+        group_version = group.preferred_version.group_version
+        try:
+            resource_list = api_client.call_api(
+                f"/apis/{group_version}", "GET",
+                header_params={'Accept': 'application/json'},
+                response_type='V1APIResourceList',
+                auth_settings=['BearerToken'],
+                _return_http_data_only=True)
+        except Exception as e:
+            logger.warning(f"Failed to discover resources of {group_version}: {e}")
+            continue
+        resource_lists.append((f"/apis/{group_version}", resource_list))
+
+    resources = []
+    for prefix, resource_list in resource_lists:
+        for resource in resource_list.resources:
+            # Skip subresources such as pods/log and types that cannot be bulk deleted
+            if not resource.namespaced or '/' in resource.name:
+                continue
+            if 'deletecollection' not in (resource.verbs or []):
+                continue
+            if resource.kind.lower() in K8S_RESET_EXCLUDED_KINDS:
+                continue
+            resources.append({'prefix': prefix, 'name': resource.name, 'kind': resource.kind})
+
+    return resources
+
+
+def _load_discovery_cache_file():
+    if not K8S_DISCOVERY_CACHE_FILE or not os.path.exists(K8S_DISCOVERY_CACHE_FILE):
+        return None
+
+    try:
+        with open(K8S_DISCOVERY_CACHE_FILE) as f:
+            cached = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable discovery cache {K8S_DISCOVERY_CACHE_FILE}: {e}")
+        return None
 
-    return True
+    return cached['fetched_at'], cached['resources']
 
-def get_grafana_user(username):
-    """Get Grafana user by username, returns None if user doesn't exist"""
+
+def _save_discovery_cache_file(fetched_at, resources):
+    if not K8S_DISCOVERY_CACHE_FILE:
+        return
+
+    # Written aside then renamed, since every server process may refresh the file
+    temporary_file = f"{K8S_DISCOVERY_CACHE_FILE}.{os.getpid()}.tmp"
     try:
-        grafana_user = grafana.users.find_user(username)
-        return grafana_user
-    except Exception as e:
-        logger.debug(f"Grafana user {username} not found: {e}")
+        with open(temporary_file, 'w') as f:
+            json.dump({'fetched_at': fetched_at, 'resources': resources}, f)
+        os.replace(temporary_file, K8S_DISCOVERY_CACHE_FILE)
+    except OSError as e:
+        logger.warning(f"Failed to write discovery cache {K8S_DISCOVERY_CACHE_FILE}: {e}")
+
+
+def get_namespaced_resources(refresh=False):
+    """Get the cached list of namespaced, deletable resource types, rediscovering it after K8S_DISCOVERY_TTL"""
+    global _k8s_discovery
+
+    with _k8s_discovery_lock:
+        if _k8s_discovery is None and not refresh:
+            _k8s_discovery = _load_discovery_cache_file()
+
+        if refresh or _k8s_discovery is None or time.time() - _k8s_discovery[0] >= K8S_DISCOVERY_TTL:
+            _k8s_discovery = (time.time(), _discover_namespaced_resources())
+            _save_discovery_cache_file(*_k8s_discovery)
+
+        return _k8s_discovery[1]
+
+
+def _search_grafana_users(perpage=1000):
+    """Yield every Grafana user through the paginated search API"""
+    page = 1
+
+    while True:
+        result = grafana.client.GET(f"/users/search?perpage={perpage}&page={page}")
+        users = result.get('users') or []
+        yield from users
+        if len(users) < perpage:
+            return
+        page += 1
+
+
+def load_grafana_directory(refresh=False):
+    """Reload the directory of all Grafana users when it is older than GRAFANA_DIRECTORY_TTL, or now with refresh"""
+    with _grafana_directory_lock:
+        rows = db.query("SELECT value FROM meta WHERE key = 'grafana_loaded_at'")
+        if not refresh and rows and time.time() - rows[0][0] < GRAFANA_DIRECTORY_TTL:
+            return
+
+        started_at = time.time()
+        with track_backend('grafana', 'list'), backend_span('grafana', 'list'):
+            users = [(user.get('login'), user.get('id'), user.get('email'), started_at)
+                     for user in _search_grafana_users()]
+
+        # Users saved by other processes during the listing are kept
+        db.run_in_transaction([
+            ("INSERT OR REPLACE INTO grafana_users (login, user_id, email, saved_at) VALUES (?, ?, ?, ?)", users),
+            ("DELETE FROM grafana_users WHERE saved_at < ?", (started_at,)),
+            ("INSERT OR REPLACE INTO meta (key, value) VALUES ('grafana_loaded_at', ?)", (started_at,)),
+        ])
+
+
+def find_cached_grafana_user(login_or_email):
+    """Look a Grafana user up by login or email in the directory cache"""
+    load_grafana_directory()
+    rows = db.query("""
+        SELECT user_id, login, email FROM grafana_users WHERE login = ? OR email = ?
+        ORDER BY login = ? DESC LIMIT 1
+    """, (login_or_email, login_or_email, login_or_email))
+
+    if not rows:
         return None
+    user_id, login, email = rows[0]
+    return {'id': user_id, 'login': login, 'email': email}
+
+
+def cache_grafana_user(username, user_id, email):
+    """Add a created account to the directory cache.
+
+    The account exists at this point: a failed cache write must not make the caller roll it back or report it failed,
+    lookups fall back to Grafana until the next directory reload.
+    """
+    try:
+        db.write("INSERT OR REPLACE INTO grafana_users (login, user_id, email, saved_at) VALUES (?, ?, ?, ?)",
+                 (username, user_id, email, time.time()))
+    except Exception as e:
+        logger.error(f"Failed to cache Grafana user {username}: {e}", exc_info=True)
+
+
+def forget_grafana_user(username):
+    """Drop a deleted account from the directory cache; a failure is logged, the next directory reload drops it"""
+    try:
+        db.write("DELETE FROM grafana_users WHERE login = ?", (username,))
+    except Exception as e:
+        logger.error(f"Failed to drop Grafana user {username} from the directory cache: {e}", exc_info=True)
+
+
+def list_grafana_logins(refresh=False):
+    """Get the logins and emails of all Grafana users from the directory cache, reloaded first if refresh is set"""
+    load_grafana_directory(refresh)
+
+    logins = set()
+    for login, email in db.query("SELECT login, email FROM grafana_users"):
+        logins.add(login)
+        logins.add(email)
+
+    logins.discard(None)
+    return logins
 
 
 def make_username(email, full_name):
@@ -234,56 +424,167 @@ def make_usernames(email, full_name):
     return username_based_email, username_based_fullname
 
 
-def get_provisioned_users():
-    keycloak_admin = get_keycloak_admin()
-
-    # Get all users with our specific attribute
-    users = keycloak_admin.get_users({
-        'q': 'managed-by:k8s-provisioner',
-        "max": -1
-    })
-    
-    # Filter users that have both required attributes
-    provisioned_users = []
-    for user in users:
-        attributes = user.get('attributes', {})
-        if (attributes.get('managed-by') == ['k8s-provisioner'] and 
-            attributes.get('provisioned') == ['true']):
-            provisioned_users.append(user)
-    
-    return provisioned_users
-
-
-def get_old_provisioned_users():
-
-    # Get all provisioned users
-    users = get_provisioned_users()
-    
-    # Filter users created more than a year ago
-    from datetime import datetime, timedelta
-    one_year_ago = datetime.now() - timedelta(days=365)
-    
-    old_users = []
-    for user in users:
-        created_timestamp = user.get('createdTimestamp', 0) / 1000  # Convert to seconds
-        created_date = datetime.fromtimestamp(created_timestamp)
-        if created_date < one_year_ago:
-            old_users.append(user)
-    
-    return old_users
-
-
-def check_namespace_exists(username):
-    """Check if a namespace exists in Kubernetes"""
-    config.load_kube_config_from_dict(
-        json.loads(os.environ.get('KUBE_CONFIG')))
-
-    with client.ApiClient() as api_client:
-        api_instance = client.CoreV1Api(api_client)
+class ProvisionedUser:
+    """The few fields of a provisioned Keycloak user the bulk operations need"""
+
+    __slots__ = ('id', 'username', 'email', 'created_at')
+
+    def __init__(self, id, username, email, created_at):
+        self.id = id
+        self.username = username
+        self.email = email
+        # Creation time in epoch seconds
+        self.created_at = created_at
+
+    @classmethod
+    def from_keycloak(cls, user):
+        return cls(
+            user.get('id'),
+            user.get('username'),
+            user.get('email'),
+            user.get('createdTimestamp', 0) / 1000
+        )
+
+    def __repr__(self):
+        return f"ProvisionedUser(username={self.username!r}, id={self.id!r})"
+
+
+@track_backend('keycloak', 'list')
+@traced('keycloak', 'list')
+def _fetch_provisioned_users_page(first, page_size, username=None):
+    query = {
+        # Keycloak filters on both attributes, so the brief representation is enough
+        'q': 'managed-by:k8s-provisioner provisioned:true',
+        'briefRepresentation': 'true',
+        'first': first,
+        'max': page_size
+    }
+    if username:
+        query.update({'username': username, 'exact': 'true'})
+
+    return get_keycloak_admin().get_users(query)
+
+
+def iter_provisioned_users(username=None, page_size=KEYCLOAK_PAGE_SIZE):
+    """Yield ProvisionedUser records, fetching the next Keycloak page while the current one is consumed"""
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        first = 0
+        next_page = submit_in_context(executor, _fetch_provisioned_users_page, first, page_size, username)
+
+        while next_page is not None:
+            page = next_page.result()
+            first += page_size
+            next_page = None
+            if len(page) == page_size:
+                next_page = submit_in_context(executor, _fetch_provisioned_users_page, first, page_size, username)
+
+            for user in page:
+                yield ProvisionedUser.from_keycloak(user)
+
+
+def list_provisioned_namespaces():
+    """Get the names of all namespaces labelled managed-by=k8s-provisioner and not Terminating, one page at a time"""
+    with _namespace_cache_lock:
+        if _namespace_cache_synced:
+            return {name for name, (phase, _) in _namespace_cache.items() if phase != 'Terminating'}
+
+    api_instance = get_core_v1_api()
+    namespaces = set()
+    _continue = None
+
+    with track_backend('k8s', 'list'), backend_span('k8s', 'list'):
+        while True:
+            page = api_instance.list_namespace(
+                label_selector=K8S_MANAGED_LABEL_SELECTOR, limit=500, _continue=_continue)
+            namespaces.update(namespace.metadata.name for namespace in page.items
+                              if namespace.status.phase != 'Terminating')
+            _continue = page.metadata._continue
+            if not _continue:
+                return namespaces
+
+
+def _cache_namespace(namespace):
+    _namespace_cache[namespace.metadata.name] = (namespace.status.phase, namespace.metadata.resource_version)
+
+
+def _run_namespace_informer():
+    """List then watch the managed namespaces, relisting whenever the watch cannot resume"""
+    global _namespace_cache, _namespace_cache_synced
+
+    api_instance = get_core_v1_api()
+
+    while True:
         try:
-            api_instance.read_namespace(username)
-            return True
+            namespaces = api_instance.list_namespace(label_selector=K8S_MANAGED_LABEL_SELECTOR)
+            with _namespace_cache_lock:
+                _namespace_cache = {}
+                for namespace in namespaces.items:
+                    _cache_namespace(namespace)
+                _namespace_cache_synced = True
+            resource_version = namespaces.metadata.resource_version
+
+            while True:
+                for event in watch.Watch().stream(api_instance.list_namespace,
+                                                  label_selector=K8S_MANAGED_LABEL_SELECTOR,
+                                                  resource_version=resource_version,
+                                                  timeout_seconds=300):
+                    namespace = event['object']
+                    resource_version = namespace.metadata.resource_version
+                    with _namespace_cache_lock:
+                        if event['type'] == 'DELETED':
+                            _namespace_cache.pop(namespace.metadata.name, None)
+                        else:
+                            _cache_namespace(namespace)
         except client.exceptions.ApiException as e:
-            if e.status == 404:
-                return False
-            raise e
+            if e.status != 410:
+                logger.error(f"Namespace informer failed: {e}", exc_info=True)
+                time.sleep(5)
+        except Exception as e:
+            logger.error(f"Namespace informer failed: {e}", exc_info=True)
+            time.sleep(5)
+
+
+def start_namespace_informer():
+    """Start the namespace informer thread once per process"""
+    global _namespace_informer
+
+    with _namespace_cache_lock:
+        if _namespace_informer is not None:
+            return
+        _namespace_informer = threading.Thread(target=_run_namespace_informer, name='namespace-informer', daemon=True)
+        _namespace_informer.start()
+
+
+def is_namespace_terminating(username):
+    """Whether the informer has seen the namespace being deleted; None when it does not know the namespace"""
+    with _namespace_cache_lock:
+        cached = _namespace_cache.get(username)
+
+    if cached is None:
+        return None
+    return cached[0] == 'Terminating'
+
+
+@track_backend('k8s', 'exists')
+@traced('k8s', 'exists')
+def check_namespace_exists(username, unlabelled=False):
+    """Check if a namespace exists in Kubernetes.
+
+    Once the informer has synced, it answers both hits and misses. With unlabelled, a miss is confirmed with the
+    API server, which also finds namespaces without the managed-by label, such as those created before it.
+    A Terminating namespace still exists; see is_namespace_terminating.
+    """
+    with _namespace_cache_lock:
+        if username in _namespace_cache:
+            return True
+        if _namespace_cache_synced and not unlabelled:
+            return False
+
+    api_instance = get_core_v1_api()
+    try:
+        api_instance.read_namespace(username)
+        return True
+    except client.exceptions.ApiException as e:
+        if e.status == 404:
+            return False
+        raise e
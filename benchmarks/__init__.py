@@ -0,0 +1,4 @@
+"""Offline benchmarks of the provisioner against in-process fake Keycloak, Grafana and Kubernetes servers.
+
+Run with ``python -m benchmarks --help``.
+"""
@@ -0,0 +1,295 @@
+"""Measure /provisioner, /reset, /sync and /cleanup against fake backends.
+
+Example:
+    python -m benchmarks --users 100,1000 --latency k8s=0.01,keycloak=0.005 --error-rate grafana=0.01 --json run.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fakes import FakeBackends
+from benchmarks.budgets import BUDGETS_FILE, load_budgets, record_budgets, check_budgets, calls_allowed_per_user
+
+ENDPOINTS = ('provisioner', 'reset', 'sync', 'cleanup')
+BACKENDS = ('keycloak', 'grafana', 'k8s')
+TOKEN = 'benchmark'
+
+
+def parse_per_backend(value):
+    """Parse '0.01' (every backend) or 'k8s=0.01,keycloak=0.005' into a backend -> float map"""
+    if not value:
+        return {}
+    if '=' not in value:
+        return {backend: float(value) for backend in BACKENDS}
+
+    result = {}
+    for term in value.split(','):
+        backend, _, number = term.partition('=')
+        if backend not in BACKENDS:
+            raise argparse.ArgumentTypeError(f"Unknown backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+        result[backend] = float(number)
+    return result
+
+
+def parse_objects(value):
+    """Parse 'pods=3,configmaps=2' into the objects seeded in every namespace"""
+    return {resource: int(count) for resource, _, count in (term.partition('=') for term in value.split(',') if term)}
+
+
+def percentile(samples, q):
+    """Nearest-rank percentile of the samples"""
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def calls_per_user(before, after, users):
+    return {backend: (after[backend] - before[backend]) / users if users else 0 for backend in before}
+
+
+def summarize(endpoint, users, samples, errors, elapsed, processed, calls):
+    return {
+        'endpoint': endpoint,
+        'users': users,
+        'runs': len(samples),
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'p99': percentile(samples, 99),
+        'throughput': processed / elapsed if elapsed else None,
+        'errors': errors,
+        'calls': calls
+    }
+
+
+class Benchmark:
+
+    def __init__(self, fakes, options):
+        self.fakes = fakes
+        self.options = options
+
+        # The provisioner reads its configuration at import time, so it is imported once the fakes run
+        os.environ.update(fakes.environment())
+        os.environ.update({
+            'VERIFICATION_TOKEN': TOKEN,
+            'INVENTORY_DB': ':memory:',
+            'K8S_DISCOVERY_CACHE_FILE': '',
+        })
+
+        from app import app, inventory
+        from app.utils import load_grafana_directory, USER_RETENTION
+
+        self.app = app
+        self.inventory = inventory
+        self.load_grafana_directory = load_grafana_directory
+        self.retention = USER_RETENTION.total_seconds()
+
+    def post(self, path, body=None):
+        started_at = time.perf_counter()
+        response = self.app.test_client().post(path, json=body if body is not None else {},
+                                               headers={'Authorization': TOKEN})
+        return time.perf_counter() - started_at, response
+
+    def prepare(self, users, expired=False, missing=0.0):
+        """Seed the fakes with provisioned users and bring the provisioner caches in line with them"""
+        created_at = time.time() - self.retention - 86400 if expired else None
+        missing_every = int(round(1 / missing)) if missing else 0
+
+        with self.fakes.quiet():
+            self.fakes.reset()
+            for index in range(users):
+                complete = not missing_every or index % missing_every
+                self.fakes.seed_user(f"bench{index:05d}", created_at, self.options.objects,
+                                     namespace=complete, grafana=complete)
+
+            self.load_grafana_directory(refresh=True)
+            self.inventory.reconcile()
+
+    def run_provisioner(self, users):
+        with self.fakes.quiet():
+            self.fakes.reset()
+            self.load_grafana_directory(refresh=True)
+
+        def provision(index):
+            return self.post('/provisioner', {'email': f"bench{index:05d}@example.com",
+                                              'full_name': f"Bench {index}"})
+
+        calls_before = self.fakes.call_counts()
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.options.concurrency) as executor:
+            outcomes = list(executor.map(provision, range(users)))
+        elapsed = time.perf_counter() - started_at
+
+        samples = [duration for duration, _ in outcomes]
+        errors = sum(1 for _, response in outcomes if response.status_code != 200)
+        calls = calls_per_user(calls_before, self.fakes.call_counts(), users)
+        return summarize('provisioner', users, samples, errors, elapsed, users, calls)
+
+    def run_bulk(self, endpoint, users, count_processed, **prepare_options):
+        """Time repeated calls of a bulk endpoint, reseeding the fakes before each one"""
+        samples = []
+        errors = 0
+        processed = 0
+        calls = dict.fromkeys(self.fakes.call_counts(), 0)
+
+        for _ in range(self.options.repeat):
+            self.prepare(users, **prepare_options)
+            calls_before = self.fakes.call_counts()
+            duration, response = self.post(f'/{endpoint}')
+            samples.append(duration)
+            for backend, count in calls_per_user(calls_before, self.fakes.call_counts(), users).items():
+                calls[backend] += count / self.options.repeat
+
+            if response.status_code != 200:
+                errors += users
+                continue
+
+            done = count_processed(response.get_json())
+            processed += done
+            errors += users - done
+
+        return summarize(endpoint, users, samples, errors, sum(samples), processed, calls)
+
+    def run_reset(self, users):
+        return self.run_bulk('reset', users, lambda result: result['namespaces_reset'])
+
+    def run_sync(self, users):
+        return self.run_bulk('sync', users, lambda result: users - len(result['results']['failed_fixes']),
+                             missing=self.options.sync_missing)
+
+    def run_cleanup(self, users):
+        return self.run_bulk('cleanup', users, lambda result: result['successfully_deleted'], expired=True)
+
+    def run(self, endpoint, users):
+        return getattr(self, f'run_{endpoint}')(users)
+
+
+def format_seconds(value):
+    return '-' if value is None else f"{value * 1000:.1f}ms" if value < 1 else f"{value:.2f}s"
+
+
+def print_report(results, baseline=None):
+    baseline = {(result['endpoint'], result['users']): result for result in baseline or []}
+    header = f"{'endpoint':<12} {'users':>6} {'runs':>5} {'p50':>10} {'p95':>10} {'p99':>10} {'users/s':>10} {'errors':>7}"
+    if baseline:
+        header += f" {'p50 vs base':>12} {'users/s vs base':>16}"
+    print(header)
+
+    for result in results:
+        line = (f"{result['endpoint']:<12} {result['users']:>6} {result['runs']:>5} "
+                f"{format_seconds(result['p50']):>10} {format_seconds(result['p95']):>10} "
+                f"{format_seconds(result['p99']):>10} {result['throughput'] or 0:>10.1f} {result['errors']:>7}")
+
+        previous = baseline.get((result['endpoint'], result['users']))
+        if previous:
+            p50_change = (result['p50'] / previous['p50'] - 1) * 100 if previous['p50'] else 0
+            throughput_change = ((result['throughput'] / previous['throughput'] - 1) * 100
+                                 if previous['throughput'] else 0)
+            line += f" {p50_change:>+11.1f}% {throughput_change:>+15.1f}%"
+        print(line)
+
+
+def print_calls(results, budgets):
+    backends = sorted({backend for result in results for backend in result['calls']})
+    print()
+    print(f"{'calls/user':<12} {'users':>6} " + ' '.join(f"{backend:>16}" for backend in backends))
+
+    for result in results:
+        endpoint_budgets = budgets.get(result['endpoint'], {})
+        cells = []
+        for backend in backends:
+            calls = result['calls'].get(backend, 0)
+            budget = endpoint_budgets.get(backend)
+            allowed = calls_allowed_per_user(budget, result['users']) if budget is not None else None
+            cells.append(f"{calls:.2f}" + (f" / {allowed:.2f}" if allowed is not None else ''))
+        print(f"{result['endpoint']:<12} {result['users']:>6} " + ' '.join(f"{cell:>16}" for cell in cells))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__.splitlines()[0])
+    parser.add_argument('--users', default='100,1000,10000',
+                        help="comma-separated numbers of users to benchmark (default: %(default)s)")
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS),
+                        help="comma-separated endpoints among %(default)s")
+    parser.add_argument('--latency', type=parse_per_backend, default={},
+                        help="seconds added to every backend call, e.g. 0.005 or k8s=0.01,keycloak=0.005")
+    parser.add_argument('--error-rate', type=parse_per_backend, default={},
+                        help="share of backend calls failing with a 503, e.g. 0.01 or grafana=0.05")
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help="concurrent POST /provisioner requests (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="calls of each bulk endpoint per number of users (default: %(default)s)")
+    parser.add_argument('--objects', type=parse_objects, default=parse_objects('pods=3,configmaps=2,secrets=1'),
+                        help="objects seeded in every namespace before a reset (default: pods=3,configmaps=2,secrets=1)")
+    parser.add_argument('--sync-missing', type=float, default=0.1,
+                        help="share of users missing their namespace and Grafana account before /sync (default: %(default)s)")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', help="results file of an earlier run to compare against")
+    parser.add_argument('--budgets', default=BUDGETS_FILE,
+                        help="backend calls per run and per user allowed for each endpoint "
+                             "(default: benchmarks/budgets.json)")
+    parser.add_argument('--check-budgets', action='store_true',
+                        help="exit with status 1 when an endpoint makes more backend calls per user than its budget")
+    parser.add_argument('--record-budgets', action='store_true',
+                        help="save the calls of this run as the new budgets; run two or more --users sizes "
+                             "to tell the fixed calls of a run from the calls per user")
+    options = parser.parse_args(argv)
+
+    options.users = [int(users) for users in options.users.split(',')]
+    options.endpoints = options.endpoints.split(',')
+    unknown = set(options.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    fakes = FakeBackends(options.latency, options.error_rate).start()
+
+    try:
+        benchmark = Benchmark(fakes, options)
+        results = []
+        for users in options.users:
+            for endpoint in options.endpoints:
+                print(f"Benchmarking {endpoint} with {users} users...", file=sys.stderr)
+                results.append(benchmark.run(endpoint, users))
+    finally:
+        fakes.stop()
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+
+    budgets = load_budgets(options.budgets)
+    print_report(results, baseline)
+    print_calls(results, budgets)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({'options': {'latency': options.latency, 'error_rate': options.error_rate,
+                                   'concurrency': options.concurrency, 'repeat': options.repeat},
+                       'results': results}, f, indent=2)
+
+    if options.record_budgets:
+        record_budgets(results, options.budgets)
+        print(f"Recorded budgets in {options.budgets}", file=sys.stderr)
+
+    if options.check_budgets:
+        if options.error_rate:
+            print("Injected errors change the number of backend calls; check budgets without --error-rate",
+                  file=sys.stderr)
+        violations = check_budgets(results, budgets)
+        for violation in violations:
+            print(f"Over budget: {violation}", file=sys.stderr)
+        if violations:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Budgets of backend calls for each benchmarked endpoint, kept in budgets.json.
+
+A budget is a fixed number of calls per run, such as a token fetch or the API discovery, plus a number of calls per user,
+so runs of any size are held to the same costs.
+"""
+import os
+import json
+import math
+
+BUDGETS_FILE = os.path.join(os.path.dirname(__file__), 'budgets.json')
+
+
+def load_budgets(path=BUDGETS_FILE):
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def calls_allowed_per_user(budget, users):
+    """Calls per user a budget allows to a run with that many users"""
+    return budget['per_user'] + budget['fixed'] / users if users else budget['per_user']
+
+
+def fit_budget(samples):
+    """Split (users, total calls) samples into per-user and fixed calls covering every sample.
+
+    The per-user cost is the slope between the smallest and largest run, so at least two sizes are needed to
+    separate the fixed overhead. It is never below the calls per user of the largest run: a slope measured on small
+    runs can fall under the true cost, and any larger run would then go over.
+    """
+    smallest, largest = min(samples), max(samples)
+    per_user = largest[1] / largest[0] if largest[0] else 0.0
+    if largest[0] > smallest[0]:
+        per_user = max(per_user, (largest[1] - smallest[1]) / (largest[0] - smallest[0]))
+    per_user = math.ceil(round(per_user * 1000, 6)) / 1000
+
+    fixed = max(0, math.ceil(round(max(total - per_user * users for users, total in samples), 6)))
+    return {'per_user': per_user, 'fixed': fixed}
+
+
+def record_budgets(results, path=BUDGETS_FILE):
+    """Save the calls measured for each endpoint and backend, across all run sizes, as the new budgets"""
+    samples = {}
+    for result in results:
+        for backend, calls in result['calls'].items():
+            samples.setdefault(result['endpoint'], {}).setdefault(backend, []).append(
+                (result['users'], calls * result['users']))
+
+    budgets = {endpoint: {backend: fit_budget(backend_samples) for backend, backend_samples in backends.items()}
+               for endpoint, backends in samples.items()}
+
+    with open(path, 'w') as f:
+        json.dump(budgets, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+    return budgets
+
+
+def check_budgets(results, budgets):
+    """List the endpoints and backends whose calls per user exceed what their budget allows at that run size"""
+    violations = []
+    for result in results:
+        endpoint_budgets = budgets.get(result['endpoint'], {})
+        for backend, calls in sorted(result['calls'].items()):
+            budget = endpoint_budgets.get(backend)
+            if budget is None:
+                continue
+            allowed = calls_allowed_per_user(budget, result['users'])
+            if calls > allowed + 1e-9:
+                violations.append(f"{result['endpoint']} with {result['users']} users: {calls:.2f} {backend} calls "
+                                  f"per user, budget {allowed:.2f} ({budget['per_user']:.2f} per user "
+                                  f"+ {budget['fixed']} per run)")
+    return violations
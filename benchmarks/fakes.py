@@ -0,0 +1,510 @@
+import re
+import json
+import time
+import uuid
+import random
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this keep-alive responses stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def _serve(self):
+        self.server.backend.serve(self)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _serve
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBackend:
+    """In-process HTTP stand-in for a backend, answering every call after `latency` seconds.
+
+    A share `error_rate` of the calls, other than authentication, fail with a 503.
+    Calls are counted per (method, route) in `calls`.
+    """
+
+    name = None
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.lock = threading.RLock()
+        self._routes = [(method, re.compile(pattern), handler) for method, pattern, handler in self.routes()]
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.backend = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f'fake-{self.name}', daemon=True)
+        self.reset()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        """Drop every stored object"""
+
+    def routes(self):
+        """List the (method, path regex, handler) triples; handlers take (match, query, body)"""
+        return []
+
+    @contextmanager
+    def quiet(self):
+        """Answer without latency or injected errors, to seed or inspect state"""
+        latency, error_rate = self.latency, self.error_rate
+        self.latency, self.error_rate = 0.0, 0.0
+        try:
+            yield self
+        finally:
+            self.latency, self.error_rate = latency, error_rate
+
+    def is_exempt(self, path):
+        """Whether a call is never failed on purpose, such as token requests"""
+        return False
+
+    def serve(self, request):
+        parts = urlsplit(request.path)
+        length = int(request.headers.get('Content-Length') or 0)
+        raw_body = request.rfile.read(length) if length else b''
+        body = json.loads(raw_body) if raw_body and 'json' in (request.headers.get('Content-Type') or '') else raw_body
+        query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        path = parts.path.rstrip('/') or '/'
+        for method, pattern, handler in self._routes:
+            match = pattern.fullmatch(path)
+            if method == request.command and match:
+                self.calls[(method, pattern.pattern)] += 1
+                if self.error_rate and not self.is_exempt(path) and random.random() < self.error_rate:
+                    status, payload, headers = 503, {'message': 'injected failure'}, {}
+                else:
+                    with self.lock:
+                        status, payload, headers = handler(match, query, body)
+                break
+        else:
+            self.calls[(request.command, 'unrouted')] += 1
+            status, payload, headers = 404, {'message': f'no route for {request.command} {path}'}, {}
+
+        data = b'' if payload is None else json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        for key, value in headers.items():
+            request.send_header(key, value)
+        request.end_headers()
+        request.wfile.write(data)
+
+    def call_count(self):
+        return sum(self.calls.values())
+
+
+class FakeKeycloak(FakeBackend):
+    """Client-credentials token endpoint and the admin users API of one realm"""
+
+    name = 'keycloak'
+    realm = 'benchmark'
+
+    def reset(self):
+        with self.lock:
+            self.users = {}
+            self.user_ids = {}
+
+    def routes(self):
+        realm = re.escape(self.realm)
+        return [
+            ('POST', rf'/realms/{realm}/protocol/openid-connect/token', self._token),
+            ('GET', rf'/admin/realms/{realm}/users', self._list_users),
+            ('POST', rf'/admin/realms/{realm}/users', self._create_user),
+            ('GET', rf'/admin/realms/{realm}/users/(?P<id>[^/]+)', self._get_user),
+            ('DELETE', rf'/admin/realms/{realm}/users/(?P<id>[^/]+)', self._delete_user),
+        ]
+
+    def is_exempt(self, path):
+        return path.endswith('/openid-connect/token')
+
+    def add_user(self, username, email, created_at=None, provisioned=True):
+        """Store a user directly, created_at being epoch seconds; returns its id"""
+        with self.lock:
+            user_id = str(uuid.uuid4())
+            attributes = {'managed-by': ['k8s-provisioner'], 'provisioned': ['true']} if provisioned else {}
+            self.users[user_id] = {
+                'id': user_id,
+                'username': username,
+                'email': email,
+                'enabled': True,
+                'createdTimestamp': int(1000 * (time.time() if created_at is None else created_at)),
+                'attributes': attributes
+            }
+            self.user_ids[username] = user_id
+            return user_id
+
+    def _token(self, match, query, body):
+        return 200, {'access_token': 'benchmark', 'expires_in': 300, 'token_type': 'Bearer'}, {}
+
+    def _list_users(self, match, query, body):
+        username = query.get('username')
+        if username and query.get('exact', '').lower() == 'true':
+            user_id = self.user_ids.get(username.lower())
+            users = [self.users[user_id]] if user_id else []
+        else:
+            users = sorted(self.users.values(), key=lambda user: user['username'])
+            if username:
+                users = [user for user in users if username.lower() in user['username']]
+
+        for condition in (query.get('q') or '').split():
+            key, _, value = condition.partition(':')
+            users = [user for user in users if value in user['attributes'].get(key, [])]
+
+        first = int(query.get('first', 0))
+        limit = int(query.get('max', 100))
+        return 200, users[first:first + limit], {}
+
+    def _create_user(self, match, query, body):
+        if body['username'] in self.user_ids:
+            return 409, {'errorMessage': 'User exists with same username'}, {}
+
+        user_id = self.add_user(body['username'], body.get('email'))
+        self.users[user_id]['attributes'] = body.get('attributes') or {}
+        return 201, None, {'Location': f"{self.url}/admin/realms/{self.realm}/users/{user_id}"}
+
+    def _get_user(self, match, query, body):
+        user = self.users.get(match['id'])
+        if user is None:
+            return 404, {'error': 'User not found'}, {}
+        return 200, user, {}
+
+    def _delete_user(self, match, query, body):
+        user = self.users.pop(match['id'], None)
+        if user is None:
+            return 404, {'error': 'User not found'}, {}
+        del self.user_ids[user['username']]
+        return 204, None, {}
+
+
+class FakeGrafana(FakeBackend):
+    """The Grafana admin and user search APIs"""
+
+    name = 'grafana'
+
+    def reset(self):
+        with self.lock:
+            self.users = {}
+            self._next_id = 1
+
+    def routes(self):
+        return [
+            ('POST', r'/api/admin/users', self._create_user),
+            ('DELETE', r'/api/admin/users/(?P<id>\d+)', self._delete_user),
+            ('GET', r'/api/users/search', self._search_users),
+            ('GET', r'/api/users/lookup', self._lookup_user),
+        ]
+
+    def add_user(self, login, email):
+        with self.lock:
+            user = {'id': self._next_id, 'login': login, 'email': email, 'name': login}
+            self.users[user['id']] = user
+            self._next_id += 1
+            return user['id']
+
+    def remove_user(self, login):
+        with self.lock:
+            for user_id, user in list(self.users.items()):
+                if user['login'] == login:
+                    del self.users[user_id]
+
+    def _create_user(self, match, query, body):
+        if any(user['login'] == body['login'] or user['email'] == body['email'] for user in self.users.values()):
+            return 412, {'message': 'User with same email or login already exists'}, {}
+        return 200, {'id': self.add_user(body['login'], body['email']), 'message': 'User created'}, {}
+
+    def _delete_user(self, match, query, body):
+        if self.users.pop(int(match['id']), None) is None:
+            return 404, {'message': 'User not found'}, {}
+        return 200, {'message': 'User deleted'}, {}
+
+    def _search_users(self, match, query, body):
+        per_page = int(query.get('perpage', 1000))
+        page = int(query.get('page', 1))
+        users = sorted(self.users.values(), key=lambda user: user['id'])
+        return 200, {
+            'totalCount': len(users),
+            'users': users[(page - 1) * per_page:page * per_page],
+            'page': page,
+            'perPage': per_page
+        }, {}
+
+    def _lookup_user(self, match, query, body):
+        login_or_email = query.get('loginOrEmail')
+        for user in self.users.values():
+            if login_or_email in (user['login'], user['email']):
+                return 200, user, {}
+        return 404, {'message': 'user not found'}, {}
+
+
+# (API path prefix, resource, kind); every resource is namespaced and supports deletecollection
+K8S_RESOURCES = [
+    ('/api/v1', 'pods', 'Pod'),
+    ('/api/v1', 'services', 'Service'),
+    ('/api/v1', 'configmaps', 'ConfigMap'),
+    ('/api/v1', 'secrets', 'Secret'),
+    ('/api/v1', 'serviceaccounts', 'ServiceAccount'),
+    ('/api/v1', 'persistentvolumeclaims', 'PersistentVolumeClaim'),
+    ('/api/v1', 'resourcequotas', 'ResourceQuota'),
+    ('/api/v1', 'events', 'Event'),
+    ('/apis/apps/v1', 'deployments', 'Deployment'),
+    ('/apis/apps/v1', 'statefulsets', 'StatefulSet'),
+    ('/apis/apps/v1', 'replicasets', 'ReplicaSet'),
+    ('/apis/batch/v1', 'jobs', 'Job'),
+    ('/apis/batch/v1', 'cronjobs', 'CronJob'),
+    ('/apis/networking.k8s.io/v1', 'ingresses', 'Ingress'),
+    ('/apis/networking.k8s.io/v1', 'networkpolicies', 'NetworkPolicy'),
+    ('/apis/rbac.authorization.k8s.io/v1', 'roles', 'Role'),
+    ('/apis/rbac.authorization.k8s.io/v1', 'rolebindings', 'RoleBinding'),
+]
+
+
+class FakeKubernetes(FakeBackend):
+    """Discovery, namespaces and namespaced collections of a Kubernetes API server.
+
+    Objects inside a namespace are only counted per resource type.
+    """
+
+    name = 'k8s'
+
+    def reset(self):
+        with self.lock:
+            # name -> {'labels': {...}, 'objects': Counter(resource -> count), 'resource_version': str}
+            self.namespaces = {}
+            self._resource_version = 0
+
+    def routes(self):
+        collection = r'(?P<prefix>/api/v1|/apis/[^/]+/[^/]+)/namespaces/(?P<namespace>[^/]+)/(?P<resource>[^/]+)'
+        return [
+            ('GET', r'/api/v1', self._core_resources),
+            ('GET', r'/apis', self._api_groups),
+            ('GET', r'/apis/(?P<group_version>[^/]+/[^/]+)', self._group_resources),
+            ('GET', r'/api/v1/namespaces', self._list_namespaces),
+            ('POST', r'/api/v1/namespaces', self._create_namespace),
+            ('GET', r'/api/v1/namespaces/(?P<name>[^/]+)', self._read_namespace),
+            ('DELETE', r'/api/v1/namespaces/(?P<name>[^/]+)', self._delete_namespace),
+            ('GET', collection, self._list_collection),
+            ('POST', collection, self._create_object),
+            ('DELETE', collection, self._delete_collection),
+        ]
+
+    def _next_resource_version(self):
+        self._resource_version += 1
+        return str(self._resource_version)
+
+    def add_namespace(self, name, labels=None, objects=None):
+        """Store a namespace directly, holding objects (resource -> count)"""
+        with self.lock:
+            self.namespaces[name] = {
+                'labels': dict(labels or {'managed-by': 'k8s-provisioner'}),
+                'objects': Counter(objects or {}),
+                'resource_version': self._next_resource_version()
+            }
+
+    def remove_namespace(self, name):
+        with self.lock:
+            self.namespaces.pop(name, None)
+
+    def fill_namespace(self, name, objects):
+        with self.lock:
+            self.namespaces[name]['objects'].update(objects)
+
+    def object_count(self, name):
+        with self.lock:
+            return sum(self.namespaces[name]['objects'].values())
+
+    @staticmethod
+    def _not_found(name):
+        return 404, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure', 'reason': 'NotFound',
+                     'message': f'namespaces "{name}" not found', 'code': 404}, {}
+
+    @staticmethod
+    def _resource_list(prefix, group_version):
+        return {
+            'kind': 'APIResourceList',
+            'groupVersion': group_version,
+            'resources': [{
+                'name': name,
+                'singularName': kind.lower(),
+                'namespaced': True,
+                'kind': kind,
+                'verbs': ['create', 'delete', 'deletecollection', 'get', 'list', 'patch', 'update', 'watch']
+            } for resource_prefix, name, kind in K8S_RESOURCES if resource_prefix == prefix]
+        }
+
+    def _core_resources(self, match, query, body):
+        return 200, self._resource_list('/api/v1', 'v1'), {}
+
+    def _api_groups(self, match, query, body):
+        group_versions = sorted({prefix[len('/apis/'):] for prefix, _, _ in K8S_RESOURCES if prefix != '/api/v1'})
+        groups = []
+        for group_version in group_versions:
+            group, version = group_version.split('/')
+            version_entry = {'groupVersion': group_version, 'version': version}
+            groups.append({'name': group, 'versions': [version_entry], 'preferredVersion': version_entry})
+        return 200, {'kind': 'APIGroupList', 'apiVersion': 'v1', 'groups': groups}, {}
+
+    def _group_resources(self, match, query, body):
+        group_version = match['group_version']
+        return 200, self._resource_list(f'/apis/{group_version}', group_version), {}
+
+    def _namespace(self, name):
+        namespace = self.namespaces[name]
+        return {
+            'apiVersion': 'v1',
+            'kind': 'Namespace',
+            'metadata': {'name': name, 'labels': namespace['labels'],
+                         'resourceVersion': namespace['resource_version']},
+            'status': {'phase': 'Active'}
+        }
+
+    def _list_namespaces(self, match, query, body):
+        selector = dict(term.split('=', 1) for term in (query.get('labelSelector') or '').split(',') if term)
+        names = sorted(name for name, namespace in self.namespaces.items()
+                       if all(namespace['labels'].get(key) == value for key, value in selector.items()))
+
+        start = int(query.get('continue') or 0)
+        limit = int(query.get('limit') or 0) or len(names)
+        page = names[start:start + limit]
+        metadata = {'resourceVersion': str(self._resource_version)}
+        if start + limit < len(names):
+            metadata['continue'] = str(start + limit)
+
+        return 200, {'apiVersion': 'v1', 'kind': 'NamespaceList', 'metadata': metadata,
+                     'items': [self._namespace(name) for name in page]}, {}
+
+    def _create_namespace(self, match, query, body):
+        name = body['metadata']['name']
+        if name in self.namespaces:
+            return 409, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure', 'reason': 'AlreadyExists',
+                         'message': f'namespaces "{name}" already exists', 'code': 409}, {}
+
+        self.add_namespace(name, body['metadata'].get('labels'))
+        return 201, self._namespace(name), {}
+
+    def _read_namespace(self, match, query, body):
+        if match['name'] not in self.namespaces:
+            return self._not_found(match['name'])
+        return 200, self._namespace(match['name']), {}
+
+    def _delete_namespace(self, match, query, body):
+        if self.namespaces.pop(match['name'], None) is None:
+            return self._not_found(match['name'])
+        return 200, {'kind': 'Status', 'apiVersion': 'v1', 'metadata': {}, 'status': 'Success'}, {}
+
+    def _list_collection(self, match, query, body):
+        if match['namespace'] not in self.namespaces:
+            return self._not_found(match['namespace'])
+
+        count = self.namespaces[match['namespace']]['objects'][match['resource']]
+        limit = int(query.get('limit') or 0) or count
+        items = [{'metadata': {'name': f"{match['resource']}-{index}", 'namespace': match['namespace']}}
+                 for index in range(min(count, limit))]
+        return 200, {'kind': 'PartialObjectMetadataList', 'apiVersion': 'meta.k8s.io/v1',
+                     'metadata': {}, 'items': items}, {}
+
+    def _create_object(self, match, query, body):
+        if match['namespace'] not in self.namespaces:
+            return self._not_found(match['namespace'])
+
+        self.namespaces[match['namespace']]['objects'][match['resource']] += 1
+        return 201, body, {}
+
+    def _delete_collection(self, match, query, body):
+        if match['namespace'] not in self.namespaces:
+            return self._not_found(match['namespace'])
+
+        self.namespaces[match['namespace']]['objects'].pop(match['resource'], None)
+        return 200, {'kind': 'Status', 'apiVersion': 'v1', 'metadata': {}, 'status': 'Success'}, {}
+
+
+class FakeBackends:
+    """The three fake servers, started together"""
+
+    def __init__(self, latency=None, error_rate=None):
+        latency = latency or {}
+        error_rate = error_rate or {}
+        self.keycloak = FakeKeycloak(latency.get('keycloak', 0.0), error_rate.get('keycloak', 0.0))
+        self.grafana = FakeGrafana(latency.get('grafana', 0.0), error_rate.get('grafana', 0.0))
+        self.k8s = FakeKubernetes(latency.get('k8s', 0.0), error_rate.get('k8s', 0.0))
+        self.all = (self.keycloak, self.grafana, self.k8s)
+
+    def start(self):
+        for backend in self.all:
+            backend.start()
+        return self
+
+    def stop(self):
+        for backend in self.all:
+            backend.stop()
+
+    def reset(self):
+        for backend in self.all:
+            backend.reset()
+
+    def call_counts(self):
+        """Calls served so far, per backend"""
+        return {backend.name: backend.call_count() for backend in self.all}
+
+    @contextmanager
+    def quiet(self):
+        with self.keycloak.quiet(), self.grafana.quiet(), self.k8s.quiet():
+            yield self
+
+    def environment(self):
+        """Environment variables pointing the provisioner at the fake servers"""
+        kube_config = {
+            'apiVersion': 'v1',
+            'kind': 'Config',
+            'clusters': [{'name': 'benchmark', 'cluster': {'server': self.k8s.url}}],
+            'users': [{'name': 'benchmark', 'user': {'token': 'benchmark'}}],
+            'contexts': [{'name': 'benchmark', 'context': {'cluster': 'benchmark', 'user': 'benchmark'}}],
+            'current-context': 'benchmark'
+        }
+        return {
+            'KEYCLOAK_BASE_URL': self.keycloak.url + '/',
+            'KEYCLOAK_REALM': self.keycloak.realm,
+            'KEYCLOAK_CLIENT_ID': 'benchmark',
+            'KEYCLOAK_CLIENT_SECRET': 'benchmark',
+            'GRAFANA_URL': self.grafana.url,
+            'GRAFANA_USER': 'admin',
+            'GRAFANA_PASSWORD': 'admin',
+            'KUBE_CONFIG': json.dumps(kube_config)
+        }
+
+    def seed_user(self, username, created_at=None, objects=None, namespace=True, grafana=True):
+        """Store a fully provisioned user in every backend, without going through the provisioner"""
+        email = f"{username}@example.com"
+        user_id = self.keycloak.add_user(username, email, created_at)
+        if namespace:
+            self.k8s.add_namespace(username, objects=dict(objects or {}, resourcequotas=1, rolebindings=1))
+        if grafana:
+            self.grafana.add_user(username, email)
+        return user_id
@@ -2,4 +2,11 @@
 
 echo "The app is starting ..."
 
-opentelemetry-instrument python run.py
\ No newline at end of file
+# exec so that gunicorn gets the SIGTERM of Kubernetes and drains its workers;
+# WSGI_SERVER=flask runs the single-process development server instead
+if [ "$WSGI_SERVER" = "flask" ]; then
+  exec opentelemetry-instrument python run.py
+fi
+
+# Not wrapped in opentelemetry-instrument: each gunicorn worker sets up tracing itself after the fork
+exec gunicorn --config gunicorn.conf.py app:app
@@ -0,0 +1,69 @@
+"""Production server configuration: gunicorn -c gunicorn.conf.py app:app
+
+Pre-forked gthread workers sized from the container CPU limit. Each worker sets up OpenTelemetry after the fork, so its
+OTLP exporter and export thread are its own, then imports the app, builds its backend clients and starts its background
+threads.
+"""
+import os
+import shutil
+import multiprocessing
+
+# Set before the app imports prometheus_client, so every worker writes its metrics to the shared directory
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/k8s-provisioner-metrics')
+
+# CPUs the container may use, from the limits.cpu of microservice.yaml (rounded up) or the host CPUs
+CPU_LIMIT = int(os.environ.get('CPU_LIMIT') or multiprocessing.cpu_count())
+# Most workers sized from CPU_LIMIT: about 80 MB each, so 4 workers and the master fit in the 0.5Gi memory limit,
+# even when CPU_LIMIT falls back to the CPUs of the node
+WEB_MAX_WORKERS = int(os.environ.get('WEB_MAX_WORKERS', 4))
+# Seconds left to the in-flight requests and background jobs of a worker after SIGTERM
+GRACEFUL_TIMEOUT = int(os.environ.get('GRACEFUL_TIMEOUT', 600))
+# Seconds kept from GRACEFUL_TIMEOUT to mark the jobs still running as interrupted
+JOB_DRAIN_MARGIN = 15
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_WORKERS') or min(2 * CPU_LIMIT + 1, WEB_MAX_WORKERS))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+# Not preloaded: the Flask instrumentation only traces apps created after it is set up in post_fork
+preload_app = False
+
+# With gthread workers the timeout only catches a stuck worker, long requests keep running
+timeout = 120
+graceful_timeout = GRACEFUL_TIMEOUT
+keepalive = 5
+# Recycle workers after that many requests (0 never does), one at a time thanks to the jitter
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    multiproc_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir)
+
+
+def post_fork(server, worker):
+    try:
+        from opentelemetry.instrumentation.auto_instrumentation import initialize
+    except ImportError:
+        server.log.warning("OpenTelemetry instrumentation is not installed, tracing is off")
+    else:
+        # What opentelemetry-instrument does at startup, configured from the OTEL_* variables of the Dockerfile
+        initialize()
+
+    from app.background import init_worker
+    init_worker()
+
+
+def worker_exit(server, worker):
+    from app.jobs import drain
+    drain(max(GRACEFUL_TIMEOUT - JOB_DRAIN_MARGIN, 0))
+
+
+def child_exit(server, worker):
+    from app.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
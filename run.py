@@ -1,8 +1,10 @@
 from app import app
+from app.background import start_background_threads
 from dotenv import load_dotenv
 
 load_dotenv("/vault/secrets/config")
 load_dotenv(".env")
 
 if __name__ == '__main__':
+    start_background_threads()
     app.run(host='0.0.0.0', debug=False)
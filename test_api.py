@@ -4,13 +4,17 @@ import sys
 from datetime import datetime
 import time
 import os
+import random
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import yaml
-from kubernetes import client, config
+from grafana_client.client import GrafanaClientError
+from kubernetes import client
 
-from app.utils import (
-    get_provisioned_users, get_grafana_user, check_namespace_exists, delete_grafana_user, delete_k8s_namespace
-)
+from app import aio
+from app.utils import iter_provisioned_users, check_namespace_exists, get_core_v1_api, grafana
 
 # Configuration
 
@@ -19,6 +23,12 @@ load_dotenv(".env")
 
 BASE_URL = "http://localhost:8080"  # Change this to your API URL
 TOKEN = os.environ.get('VERIFICATION_TOKEN')
+# Seconds to wait for the backends to reach the expected state before a verification fails
+VERIFY_TIMEOUT = int(os.environ.get('VERIFY_TIMEOUT', 300))
+# Seconds before an HTTP request of the load test is abandoned
+LOAD_REQUEST_TIMEOUT = int(os.environ.get('LOAD_REQUEST_TIMEOUT', 600))
+# Upper bounds, in seconds, of the latency histogram buckets of the load test
+LOAD_HISTOGRAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf'))
 
 def print_response(response):
     """Helper function to print response details"""
@@ -30,6 +40,52 @@ def print_response(response):
         print("Response:", response.text)
     print("-" * 80)
 
+def wait_for(condition, timeout=VERIFY_TIMEOUT, interval=0.5):
+    """Poll condition until it returns a truthy value, backing off up to 5 seconds between checks.
+
+    Exceptions raised by condition count as not yet; returns whether it succeeded before timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if condition():
+                return True
+        except Exception:
+            pass
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(min(interval, max(0, deadline - time.monotonic())))
+        interval = min(interval * 1.5, 5)
+
+def keycloak_user_exists(username, email=None):
+    """Look the provisioned Keycloak user up by exact username"""
+    return any(user.username == username and (email is None or user.email == email)
+               for user in iter_provisioned_users(username))
+
+def grafana_user_exists(username):
+    """Ask Grafana directly, as the provisioner's user directory is only reloaded every few minutes"""
+    try:
+        return bool(grafana.users.find_user(username))
+    except GrafanaClientError as e:
+        if e.status_code == 404:
+            return False
+        raise
+
+def configmap_exists(username):
+    try:
+        get_core_v1_api().read_namespaced_config_map(name="test-configmap", namespace=username)
+        return True
+    except client.exceptions.ApiException as e:
+        if e.status == 404:
+            return False
+        raise
+
+def user_is_provisioned(username, email=None):
+    return check_namespace_exists(username) and grafana_user_exists(username) and keycloak_user_exists(username, email)
+
+def user_is_gone(username):
+    return not (check_namespace_exists(username) or grafana_user_exists(username) or keycloak_user_exists(username))
+
 def verify_user_creation(username, email):
     """Verify that a user was properly created in all systems"""
     print("\n=== Verifying User Creation ===")
@@ -40,11 +96,8 @@ def verify_user_creation(username, email):
     }
     
     # Verify Keycloak user
-    users = get_provisioned_users()
-    for user in users:
-        if user.get('username') == username and user.get('email') == email:
-            verification_results['keycloak'] = True
-            break
+    if keycloak_user_exists(username, email):
+        verification_results['keycloak'] = True
     
     # Verify Kubernetes namespace
     if check_namespace_exists(username):
@@ -52,7 +105,7 @@ def verify_user_creation(username, email):
     
     # Verify Grafana user
     try:
-        if get_grafana_user(username):
+        if grafana_user_exists(username):
             verification_results['grafana'] = True
     except Exception as e:
         print(f"Grafana user not found: {e}")
@@ -71,11 +124,8 @@ def verify_user_deletion(username):
     }
     
     # Verify Keycloak user
-    users = get_provisioned_users()
-    for user in users:
-        if user.get('username') == username:
-            verification_results['keycloak'] = False
-            break
+    if keycloak_user_exists(username):
+        verification_results['keycloak'] = False
     
     # Verify Kubernetes namespace
     if check_namespace_exists(username):
@@ -83,7 +133,7 @@ def verify_user_deletion(username):
     
     # Verify Grafana user
     try:
-        if get_grafana_user(username):
+        if grafana_user_exists(username):
             verification_results['grafana'] = False
     except Exception as e:
         # If we get an exception, it means the user doesn't exist, which is what we want
@@ -95,30 +145,26 @@ def verify_user_deletion(username):
 
 def create_test_configmap(username):
     """Create a test ConfigMap in the user's namespace"""
-    config.load_kube_config_from_dict(
-        json.loads(os.environ.get('KUBE_CONFIG')))
+    api_instance = get_core_v1_api()
 
-    with client.ApiClient() as api_client:
-        api_instance = client.CoreV1Api(api_client)
-        
-        configmap = client.V1ConfigMap(
-            metadata=client.V1ObjectMeta(
-                name="test-configmap",
-                namespace=username
-            ),
-            data={"test": "data"}
+    configmap = client.V1ConfigMap(
+        metadata=client.V1ObjectMeta(
+            name="test-configmap",
+            namespace=username
+        ),
+        data={"test": "data"}
+    )
+    
+    try:
+        api_instance.create_namespaced_config_map(
+            namespace=username,
+            body=configmap
         )
-        
-        try:
-            api_instance.create_namespaced_config_map(
-                namespace=username,
-                body=configmap
-            )
-            print(f"Created test ConfigMap in namespace {username}")
-            return True
-        except Exception as e:
-            print(f"Failed to create test ConfigMap: {e}")
-            return False
+        print(f"Created test ConfigMap in namespace {username}")
+        return True
+    except Exception as e:
+        print(f"Failed to create test ConfigMap: {e}")
+        return False
 
 def verify_namespace_reset(username):
     """Verify that a namespace was properly reset by checking if the test ConfigMap still exists"""
@@ -134,28 +180,24 @@ def verify_namespace_reset(username):
         
         # Check if test ConfigMap still exists
         try:
-            config.load_kube_config_from_dict(
-                json.loads(os.environ.get('KUBE_CONFIG')))
-
-            with client.ApiClient() as api_client:
-                api_instance = client.CoreV1Api(api_client)
-                
-                try:
-                    # Try to get the test ConfigMap
-                    api_instance.read_namespaced_config_map(
-                        name="test-configmap",
-                        namespace=username
-                    )
-                    # If we get here, the ConfigMap still exists
-                    verification_results['configmap_deleted'] = False
-                    print(f"Test ConfigMap still exists in namespace {username}")
-                except client.exceptions.ApiException as e:
-                    if e.status == 404:
-                        # ConfigMap not found, which is what we want
-                        verification_results['configmap_deleted'] = True
-                    else:
-                        raise e
-                
+            api_instance = get_core_v1_api()
+
+            try:
+                # Try to get the test ConfigMap
+                api_instance.read_namespaced_config_map(
+                    name="test-configmap",
+                    namespace=username
+                )
+                # If we get here, the ConfigMap still exists
+                verification_results['configmap_deleted'] = False
+                print(f"Test ConfigMap still exists in namespace {username}")
+            except client.exceptions.ApiException as e:
+                if e.status == 404:
+                    # ConfigMap not found, which is what we want
+                    verification_results['configmap_deleted'] = True
+                else:
+                    raise e
+
         except Exception as e:
             print(f"Error checking ConfigMap: {e}")
     
@@ -183,8 +225,8 @@ def test_create_user(email, full_name):
         user_data = response.json()
         username = user_data.get('username')
         
-        # Wait a bit for all systems to sync
-        time.sleep(5)
+        # Wait for the namespace to be available
+        wait_for(lambda: check_namespace_exists(username))
         
         # Create test ConfigMap
         if create_test_configmap(username):
@@ -223,8 +265,8 @@ def test_delete_user(email, full_name):
         user_data = response.json()
         username = user_data.get('username')
         
-        # Wait a bit for all systems to sync
-        time.sleep(5)
+        # Wait for the namespace to finish terminating and the accounts to disappear
+        wait_for(lambda: user_is_gone(username))
         
         # Verify user deletion
         if verify_user_deletion(username):
@@ -250,8 +292,8 @@ def test_reset_namespaces(username):
     print_response(response)
     
     if response.status_code == 200:
-        # Wait a bit for all systems to sync
-        time.sleep(5)
+        # Wait for the namespace objects to be deleted
+        wait_for(lambda: not configmap_exists(username))
         
         # Verify namespace reset for the specific user
         if verify_namespace_reset(username):
@@ -279,8 +321,9 @@ def test_cleanup_old_users():
     if response.status_code == 200:
         result = response.json()
         
-        # Wait a bit for all systems to sync
-        time.sleep(5)
+        # Wait for every deleted user to disappear from all systems
+        deleted_usernames = [user.get('username') for user in result.get('deleted_users', [])]
+        wait_for(lambda: all(user_is_gone(username) for username in deleted_usernames))
         
         # Verify user deletions
         all_verified = True
@@ -382,15 +425,18 @@ def test_sync_user():
     
     # Delete Grafana user
     try:
-        delete_grafana_user(username)
+        aio.run(aio.delete_grafana_user(username))
         print("✓ Grafana account deleted")
     except Exception as e:
         print(f"✗ Failed to delete Grafana account: {e}")
         return False
     
-    # Delete K8s namespace
+    # Delete K8s namespace and wait for it to finish terminating
     try:
-        delete_k8s_namespace(username)
+        aio.run(aio.delete_k8s_namespace(username))
+        if not wait_for(lambda: not check_namespace_exists(username)):
+            print("✗ K8s namespace still terminating")
+            return False
         print("✓ K8s namespace deleted")
     except Exception as e:
         print(f"✗ Failed to delete K8s namespace: {e}")
@@ -411,15 +457,15 @@ def test_sync_user():
         print("✗ Sync failed")
         return False
     
-    # Wait a bit for all systems to sync
-    time.sleep(5)
+    # Wait for the Grafana account and namespace to be recreated
+    wait_for(lambda: grafana_user_exists(username) and check_namespace_exists(username))
     
     # Step 4: Verify recreation
     print("\n4. Verifying recreation...")
     
     # Verify Grafana user recreation
     try:
-        grafana_user = get_grafana_user(username)
+        grafana_user = grafana_user_exists(username)
         if grafana_user:
             print("✓ Grafana account recreated")
         else:
@@ -497,9 +543,11 @@ def test_user_lifecycle():
     
     # Delete Grafana user and K8s namespace
     try:
-        delete_grafana_user(username)
-        delete_k8s_namespace(username)
-        time.sleep(10)
+        aio.run(aio.delete_grafana_user(username))
+        aio.run(aio.delete_k8s_namespace(username))
+        if not wait_for(lambda: not check_namespace_exists(username)):
+            print("✗ K8s namespace still terminating")
+            return results
         print("✓ Resources deleted for sync test")
     except Exception as e:
         print(f"✗ Failed to delete resources: {e}")
@@ -520,11 +568,11 @@ def test_user_lifecycle():
         return results
     
     # Wait for sync to complete
-    time.sleep(5)
+    wait_for(lambda: grafana_user_exists(username) and check_namespace_exists(username))
     
     # Verify sync results
     try:
-        grafana_user = get_grafana_user(username)
+        grafana_user = grafana_user_exists(username)
         namespace_exists = check_namespace_exists(username)
         
         if grafana_user and namespace_exists:
@@ -575,11 +623,195 @@ def test_user_lifecycle():
     
     return results
 
+class LoadStats:
+    """Latencies per step and error counts collected by the virtual users of a load stage"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def record(self, step, duration, error=None):
+        """Record a latency, unless duration is None, and the error if any"""
+        with self.lock:
+            if duration is not None:
+                self.latencies[step].append(duration)
+            if error:
+                self.errors[(step, error)] += 1
+
+    def enter(self):
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def leave(self, succeeded):
+        with self.lock:
+            self.in_flight -= 1
+            if succeeded:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+def timed_request(stats, session, method, path, body):
+    """Call the provisioner, recording the latency under "<method> <path>"; returns the JSON body or None on error"""
+    step = f"{method} {path}"
+    started_at = time.monotonic()
+    try:
+        response = session.request(method, f"{BASE_URL}{path}", json=body, timeout=LOAD_REQUEST_TIMEOUT,
+                                   headers={'Authorization': TOKEN, 'Content-Type': 'application/json'})
+    except requests.RequestException as e:
+        stats.record(step, time.monotonic() - started_at, type(e).__name__)
+        return None
+
+    duration = time.monotonic() - started_at
+    if response.status_code != 200:
+        stats.record(step, duration, f"HTTP {response.status_code}")
+        return None
+
+    stats.record(step, duration)
+    return response.json()
+
+def timed_wait(stats, step, condition):
+    """Poll until the expected state is reached, recording how long it took; False on timeout"""
+    started_at = time.monotonic()
+    reached = wait_for(condition)
+    stats.record(step, time.monotonic() - started_at, None if reached else 'timeout')
+    return reached
+
+def run_virtual_user(stats, email, full_name):
+    """Drive one user through create, reset, sync and delete, verifying each step by polling"""
+    session = requests.Session()
+    username = None
+    deleted = False
+
+    try:
+        created = timed_request(stats, session, 'POST', '/provisioner', {'email': email, 'full_name': full_name})
+        if not created:
+            return False
+        username = created['username']
+        if not timed_wait(stats, 'wait created', lambda: user_is_provisioned(username, email)):
+            return False
+
+        get_core_v1_api().create_namespaced_config_map(namespace=username, body=client.V1ConfigMap(
+            metadata=client.V1ObjectMeta(name="test-configmap", namespace=username), data={"test": "data"}))
+        reset = timed_request(stats, session, 'POST', '/reset', {'username': username})
+        if not reset:
+            return False
+        if reset.get('failed_resets'):
+            stats.record('POST /reset', None, 'failed_resets')
+            return False
+        if not timed_wait(stats, 'wait reset', lambda: not configmap_exists(username)):
+            return False
+
+        aio.run(aio.delete_grafana_user(username))
+        aio.run(aio.delete_k8s_namespace(username))
+        if not timed_wait(stats, 'wait namespace deleted', lambda: not check_namespace_exists(username)):
+            return False
+        synced = timed_request(stats, session, 'POST', '/sync', {'username': username})
+        if not synced:
+            return False
+        if synced['results']['failed_fixes']:
+            stats.record('POST /sync', None, 'failed_fixes')
+            return False
+        if not timed_wait(stats, 'wait synced', lambda: grafana_user_exists(username) and check_namespace_exists(username)):
+            return False
+
+        if not timed_request(stats, session, 'DELETE', '/provisioner', {'email': email, 'full_name': full_name}):
+            return False
+        deleted = True
+        return timed_wait(stats, 'wait deleted', lambda: user_is_gone(username))
+    except Exception as e:
+        stats.record('lifecycle', None, type(e).__name__)
+        return False
+    finally:
+        # Do not leave half-tested users behind
+        if username and not deleted:
+            try:
+                session.delete(f"{BASE_URL}/provisioner", json={'email': email, 'full_name': full_name},
+                               headers={'Authorization': TOKEN}, timeout=LOAD_REQUEST_TIMEOUT)
+            except requests.RequestException:
+                pass
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[max(0, -(-len(ordered) * q // 100) - 1)]
+
+def print_load_report(stats, rate, users, elapsed):
+    print(f"\n=== Load stage: {users} virtual users at {rate}/s ===")
+    print(f"Duration: {elapsed:.1f}s, completed: {stats.completed}, failed: {stats.failed}, "
+          f"peak concurrent users: {stats.peak_in_flight}, lifecycles/s: {stats.completed / elapsed:.2f}")
+
+    print(f"\n{'step':<24} {'count':>6} {'p50':>8} {'p90':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for step, samples in stats.latencies.items():
+        print(f"{step:<24} {len(samples):>6} {percentile(samples, 50):>7.2f}s {percentile(samples, 90):>7.2f}s "
+              f"{percentile(samples, 95):>7.2f}s {percentile(samples, 99):>7.2f}s {max(samples):>7.2f}s")
+
+    for step, samples in stats.latencies.items():
+        if not step.startswith(('POST', 'DELETE')):
+            continue
+        print(f"\n{step} latency histogram:")
+        lower = 0
+        for upper in LOAD_HISTOGRAM_BUCKETS:
+            count = sum(1 for sample in samples if lower <= sample < upper)
+            label = f"{lower:g}-{upper:g}s" if upper != float('inf') else f">= {lower:g}s"
+            print(f"  {label:>12} {count:>6} {'#' * round(50 * count / len(samples))}")
+            lower = upper
+
+    print("\nErrors:")
+    if not stats.errors:
+        print("  none")
+    for (step, error), count in stats.errors.most_common():
+        print(f"  {step:<24} {error:<24} {count:>6}")
+
+def run_load_stage(users, rate, max_concurrency, run_id):
+    """Start users virtual users with Poisson arrivals at rate per second, at most max_concurrency at once"""
+    stats = LoadStats()
+
+    def virtual_user(index):
+        stats.enter()
+        succeeded = False
+        try:
+            succeeded = run_virtual_user(stats, f"load_{run_id}_{index}@example.com", f"Load User {run_id} {index}")
+        finally:
+            stats.leave(succeeded)
+
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for index in range(users):
+            if index:
+                time.sleep(random.expovariate(rate))
+            executor.submit(virtual_user, index)
+
+    print_load_report(stats, rate, users, time.monotonic() - started_at)
+    return stats
+
+def test_load(users, rates, max_concurrency=None):
+    """Run one load stage per arrival rate, to find the rate at which the provisioner saturates"""
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    summary = []
+
+    for stage, rate in enumerate(rates):
+        stats = run_load_stage(users, rate, max_concurrency or users, f"{run_id}s{stage}")
+        summary.append((rate, stats))
+
+    print("\n=== Load summary ===")
+    print(f"{'rate/s':>8} {'completed':>10} {'failed':>8} {'peak users':>11} {'create p95':>11}")
+    for rate, stats in summary:
+        create_latencies = stats.latencies.get('POST /provisioner') or [0]
+        print(f"{rate:>8g} {stats.completed:>10} {stats.failed:>8} {stats.peak_in_flight:>11} "
+              f"{percentile(create_latencies, 95):>10.2f}s")
+    return summary
+
 def main():
     if len(sys.argv) < 2:
-        print("Usage: python test_api.py [create|delete|reset|cleanup|all|process|sync|lifecycle]")
+        print("Usage: python test_api.py [create|delete|reset|cleanup|all|process|sync|lifecycle|load]")
         print("For create/delete, provide email and full_name as additional arguments")
         print("For reset, provide username as additional argument")
+        print("For load, provide the virtual users per stage, the arrival rates and optionally the maximum concurrency")
         return
 
     command = sys.argv[1].lower()
@@ -618,8 +850,16 @@ def main():
 
     elif command == "process":
         test_process()
+
+    elif command == "load":
+        if len(sys.argv) not in (4, 5):
+            print("Usage: python test_api.py load <users_per_stage> <rate[,rate...]> [max_concurrency]")
+            return
+        rates = [float(rate) for rate in sys.argv[3].split(',')]
+        max_concurrency = int(sys.argv[4]) if len(sys.argv) == 5 else None
+        test_load(int(sys.argv[2]), rates, max_concurrency)
     else:
-        print("Invalid command. Use: create, delete, reset, cleanup, all, process, sync, or lifecycle")
+        print("Invalid command. Use: create, delete, reset, cleanup, all, process, sync, lifecycle, or load")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file